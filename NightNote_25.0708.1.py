@@ -1,27 +1,41 @@
-
+import argparse
+import os
 import platform
+import shutil
+import sys
+from nightnote_core import (JOURNAL_FSYNC_MS, Journal, RopeBuffer, Session, TrigramIndex,
+                            get_matcher, parallel_grep, read_lines, replay_journal,
+                            restore_session, save_session)
 __mainname__ = "NightNote"
 __version__ = "25.0708.1"
 __author__ = "DONGFANG Lingye"
 __email__ = "ly@lingye.online"
 
 # 历史记录相关
-history = []
-redo_history = []
-operation_history = []
-MAX_HISTORY = 10
+HISTORY_MEMORY_LIMIT = 256 * 1024 * 1024  # 撤销历史的内存预算（字节）
+session = Session(HISTORY_MEMORY_LIMIT)  # 缓冲区、文件名和历史都由编辑核心管理
+history = session.history
+operation_history = session.operation_history
+INCREMENTAL_SAVE = True  # 只修改了文件后半部分时允许原地重写尾部
+QUIET = False  # 批处理模式：不输出提示和缓冲区大小
+error_count = 0  # 出错的命令数，批处理模式据此决定退出码
 def print_help():
     print(f"{__mainname__} version {__version__} by {__author__} <{__email__}>")
     print('''
         Command list:
-        p               Print all lines
+        p [range]       Print lines, e.g. p 100,200 | p $-50,$ | p /regex/ | p /a/,/b/
+        pg [range]      Print lines page by page
         i [n]           Insert after line n (end with '.')
         a               Append at end (end with '.')
+        R [n] [filename] Read file after line n (default: end); '-' reads stdin to EOF
         d [n]           Delete line n
         w [filename]    Write buffer to file
         o [filename]    Open file and load to buffer
+        om [filename]   Open large file lazily (memory-mapped)
         s [pattern]     Search for pattern (regex supported)
+        sa [pattern]    Search all buffers (large buffers are searched in parallel)
         r [pattern] [replacement] Replace pattern (regex supported)
+                        s/r accept -i (ignore case) and -w (whole word), e.g. s -iw foo
         u l             List buffers
         u c             Clear buffer
         u s [n]         Switch buffer (0~N)
@@ -29,162 +43,308 @@ def print_help():
         u z             Undo last operation
         u y             Redo last undo
         u h             List operation history
+        u t             Build/drop trigram search index for current buffer
         q               Quit
         h               Show this help
         b               Debug info (OS version, Python version, etc.)
         v               Show about info
+
+        Batch mode:     nightnote -s script.ned [-o out] [file]
+                        Runs the script (one command per line, i/a text ends with '.')
+                        without prompts; exit status is non-zero on the first error
+
+        Sessions:       nightnote --session work.nns [file]
+                        Restores buffers and history from work.nns and saves them back
+                        on exit; unchanged files are stored by reference
+
+        Crash recovery: nightnote --journal work.nnj [--fsync always|never|MS] [file]
+                        Logs every change to work.nnj before applying it and replays
+                        it on the next start if the editor did not exit cleanly.
+                        Records are written out before each prompt (scripts: every
+                        64 KB); --fsync sets when they are flushed to disk
         ''')
 lines = []  # 用于存储文本的每一行
-buffers = [[]]  # 多个缓冲区，初始一个
-buffer_files = [""]  # 记录每个缓冲区对应的文件名（如有）
-current_buffer = 0  # 当前缓冲区编号
+buffers = session.buffers  # 多个缓冲区，初始一个
+buffer_files = session.buffer_files  # 记录每个缓冲区对应的文件名（如有）
 
 def get_lines():
-    return buffers[current_buffer]
-
-def set_lines(new_lines):
-    buffers[current_buffer] = new_lines
+    return session.buffer
 
-def save_state(operation):
-    """保存当前状态到历史记录"""
-    if len(history) >= MAX_HISTORY:
-        history.pop(0)
-    history.append((current_buffer, buffers[current_buffer][:], buffer_files[current_buffer]))
-    operation_history.append((operation, current_buffer))
-    redo_history.clear()
-
-def set_buffer_file(filename):
-    while len(buffer_files) <= current_buffer:
-        buffer_files.append("")
-    buffer_files[current_buffer] = filename
+def edit_lines(operation, start, stop, new_lines):
+    """用 new_lines 替换当前缓冲区 [start, stop) 行并记入历史，返回被删除的行"""
+    return session.edit(operation, start, stop, new_lines)
 
 def get_buffer_file(idx):
     if idx < len(buffer_files):
         return buffer_files[idx]
     return ""
     
+def info(message):
+    """输出操作结果提示，批处理模式下不输出"""
+    if not QUIET:
+        print(message)
+
+def error(message):
+    """输出错误信息并计数，批处理模式下写到 stderr"""
+    global error_count
+    error_count += 1
+    print(message, file=sys.stderr if QUIET else sys.stdout)
+
 def show_buffer_size():
-    lines = get_lines()
-    total_bytes = sum(len(line.encode('utf-8')) + 1 for line in lines)
-    print(f"buffer {current_buffer} {len(lines)} lines {total_bytes} bytes")
+    if QUIET:
+        return
+    line_count, total_bytes, _ = get_lines().stats()
+    print(f"buffer {session.current} {line_count} lines {total_bytes} bytes")
 
 def select_file(filename):
     if not filename:
-        print("E:Please specify a filename")
+        error("E:Please specify a filename")
         return
         
     try:
-        with open(filename, "r") as f:
-            set_lines([line.rstrip('\n') for line in f])
-        set_buffer_file(filename)
-        print(f"File '{filename}' loaded successfully")
+        session.open(filename)
+        info(f"File '{filename}' loaded successfully")
     except FileNotFoundError:
-        print(f"E:File '{filename}' not found")
-        set_lines([])
-        set_buffer_file("")
+        error(f"E:File '{filename}' not found")
+        session.load([])
     except PermissionError:
-        print(f"E:Permission denied when accessing '{filename}'")
-        set_lines([])
-        set_buffer_file("")
+        error(f"E:Permission denied when accessing '{filename}'")
+        session.load([])
     except Exception as e:
-        print(f"E:Failed to open file '{filename}': {str(e)}")
-        set_lines([])
-        set_buffer_file("")
+        error(f"E:Failed to open file '{filename}': {str(e)}")
+        session.load([])
     show_buffer_size()
 
-def p():
+def select_file_mapped(filename):
+    """以内存映射方式打开文件，只建立行索引，行在用到时才解码"""
+    if not filename:
+        error("E:Please specify a filename")
+        return
+        
+    try:
+        session.open(filename, mapped=True)
+        info(f"File '{filename}' mapped successfully")
+    except FileNotFoundError:
+        error(f"E:File '{filename}' not found")
+        session.load([])
+    except PermissionError:
+        error(f"E:Permission denied when accessing '{filename}'")
+        session.load([])
+    except Exception as e:
+        error(f"E:Failed to map file '{filename}': {str(e)}")
+        session.load([])
     show_buffer_size()
-    lines = get_lines()
-    for idx, line in enumerate(lines, 1):
-        print(f"{idx}: {line}")
 
-def insert(n):
+OUTPUT_CHUNK_BYTES = 1024 * 1024  # 打印时攒够这么多再写一次 stdout
+
+def parse_address(spec, pos, lines, after=0):
+    """解析 spec[pos:] 开头的行地址（n、$、/正则/，可跟 +n/-n），返回 (行号, 新位置)
+
+    /正则/ 从第 after 行（从 0 开始计）起查找第一个匹配的行。
+    """
+    if pos < len(spec) and spec[pos].isdigit():
+        end = pos
+        while end < len(spec) and spec[end].isdigit():
+            end += 1
+        value = int(spec[pos:end])
+        pos = end
+    elif spec.startswith("$", pos):
+        value = len(lines)
+        pos += 1
+    elif spec.startswith("/", pos):
+        end = spec.find("/", pos + 1)
+        if end < 0:
+            end = len(spec)
+        pattern = spec[pos + 1:end]
+        hit = next(get_matcher(pattern).grep(lines.iter_chunks(after), after), None)
+        if hit is None:
+            raise ValueError(f"No match for /{pattern}/")
+        value = hit[0] + 1
+        pos = end + 1
+    else:
+        raise ValueError("Invalid address")
+    while pos < len(spec) and spec[pos] in "+-":
+        sign = 1 if spec[pos] == "+" else -1
+        end = pos + 1
+        while end < len(spec) and spec[end].isdigit():
+            end += 1
+        value += sign * (int(spec[pos + 1:end]) if end > pos + 1 else 1)
+        pos = end
+    return value, pos
+
+def parse_range(spec, lines):
+    """把 "100,200"、"$-50,$"、"/a/,/b/" 这类范围解析成 (首行, 末行)，行号从 1 开始"""
+    spec = spec.strip()
+    if spec in ("", ","):
+        return 1, len(lines)
+    first, pos = parse_address(spec, 0, lines)
+    last = first
+    if spec.startswith(",", pos):
+        last, pos = parse_address(spec, pos + 1, lines, after=first)
+    if pos != len(spec):
+        raise ValueError("Invalid address")
+    if first < 1 or last < first or last > len(lines):
+        raise ValueError(f"Invalid range, buffer has {len(lines)} lines")
+    return first, last
+
+def print_lines(first, last):
+    """把 [first, last] 行按大块写到 stdout"""
+    out = sys.stdout
+    parts = []
+    size = 0
+    idx = first
+    for chunk in get_lines().iter_chunks(first - 1, last):
+        text = "".join([f"{i}: {line}\n" for i, line in enumerate(chunk, idx)])
+        idx += len(chunk)
+        parts.append(text)
+        size += len(text)
+        if size >= OUTPUT_CHUNK_BYTES:
+            out.write("".join(parts))
+            parts = []
+            size = 0
+    out.write("".join(parts))
+    out.flush()
+
+def p(spec="", pager=False):
     show_buffer_size()
-    lines = get_lines()
-    if n < 0 or n > len(lines):
-        print(f"E:Line number must be between 0 and {len(lines)}")
+    import re
+    try:
+        first, last = parse_range(spec, get_lines())
+    except re.error:
+        error("E:Invalid regular expression")
         return
-        
-    print(f"Inserting after line {n}. Enter lines (end with '.'):")
-    insert_lines = []
+    except ValueError as e:
+        error(f"E:{e}")
+        return
+    if not pager or not sys.stdout.isatty():
+        print_lines(first, last)
+        return
+    height = max(shutil.get_terminal_size().lines - 1, 1)
+    while first <= last:
+        end = min(last, first + height - 1)
+        print_lines(first, end)
+        first = end + 1
+        if first <= last:
+            try:
+                answer = input(f"--More-- ({end}/{last}) ")
+            except EOFError:
+                break
+            if answer.strip().lower() == "q":
+                break
+
+def read_text_lines():
+    """交互读入文本行直到单独一行 '.'，输入中断时返回 None"""
+    text_lines = []
     while True:
         try:
             text = input()
-            if text == ".":
-                break
-            insert_lines.append(text)
         except EOFError:
-            print("\nE:Input interrupted, insertion cancelled")
+            return None
+        if text == ".":
+            return text_lines
+        text_lines.append(text)
+
+def insert(n, insert_lines=None):
+    """在第 n 行后插入；insert_lines 为 None 时交互读入"""
+    show_buffer_size()
+    lines = get_lines()
+    if n < 0 or n > len(lines):
+        error(f"E:Line number must be between 0 and {len(lines)}")
+        return
+        
+    if insert_lines is None:
+        info(f"Inserting after line {n}. Enter lines (end with '.'):")
+        insert_lines = read_text_lines()
+        if insert_lines is None:
+            error("\nE:Input interrupted, insertion cancelled")
             return
             
     if insert_lines:
-        save_state(f"insert after line {n}")
-        lines[n:n] = insert_lines
-        set_lines(lines)
-        print(f"Inserted {len(insert_lines)} lines after line {n}")
+        edit_lines(f"insert after line {n}", n, n, insert_lines)
+        info(f"Inserted {len(insert_lines)} lines after line {n}")
     show_buffer_size()
 
-def append():
+def append(append_lines=None):
+    """追加到末尾；append_lines 为 None 时交互读入"""
     show_buffer_size()
     lines = get_lines()
-    print("Appending to end. Enter lines (end with '.'):")
-    append_lines = []
-    while True:
-        try:
-            text = input()
-            if text == ".":
-                break
-            append_lines.append(text)
-        except EOFError:
-            print("\nE:Input interrupted, append cancelled")
+    if append_lines is None:
+        info("Appending to end. Enter lines (end with '.'):")
+        append_lines = read_text_lines()
+        if append_lines is None:
+            error("\nE:Input interrupted, append cancelled")
             return
             
     if append_lines:
-        save_state("append")
-        lines.extend(append_lines)
-        set_lines(lines)
-        print(f"Appended {len(append_lines)} lines")
+        edit_lines("append", len(lines), len(lines), append_lines)
+        info(f"Appended {len(append_lines)} lines")
+    show_buffer_size()
+
+def read_file(n, filename):
+    """把文件（'-' 表示标准输入）整块读入并插到第 n 行后，只记一条历史"""
+    lines = get_lines()
+    if n is None:
+        n = len(lines)
+    if n < 0 or n > len(lines):
+        error(f"E:Line number must be between 0 and {len(lines)}")
+        return
+    source = "stdin" if filename == "-" else f"'{filename}'"
+    operation = f"read {source} after line {n}"
+    try:
+        if filename == "-":
+            new_lines = read_lines(sys.stdin)
+        else:
+            new_lines = session.read_file(operation, n, filename)
+    except FileNotFoundError:
+        error(f"E:File '{filename}' not found")
+        return
+    except PermissionError:
+        error(f"E:Permission denied when accessing '{filename}'")
+        return
+    except Exception as e:
+        error(f"E:Failed to read '{filename}': {str(e)}")
+        return
+    if filename == "-" and new_lines:
+        # 标准输入没法重读，内容只能整个记进 Journal
+        edit_lines(operation, n, n, new_lines)
+    info(f"Read {len(new_lines)} lines after line {n}")
     show_buffer_size()
 
 def delete(n):
     lines = get_lines()
     if n < 1 or n > len(lines):
-        print(f"E:Line number must be between 1 and {len(lines)}")
+        error(f"E:Line number must be between 1 and {len(lines)}")
         return
         
-    save_state(f"delete line {n}")
-    deleted_line = lines.pop(n-1)
-    set_lines(lines)
-    print(f"Deleted line {n}: {deleted_line[:50]}{'...' if len(deleted_line) > 50 else ''}")
+    deleted_line = edit_lines(f"delete line {n}", n-1, n, [])[0]
+    info(f"Deleted line {n}: {deleted_line[:50]}{'...' if len(deleted_line) > 50 else ''}")
     show_buffer_size()
 
 def write(filename):
     if not filename:
-        print("E:Please specify a filename")
+        error("E:Please specify a filename")
         return
         
     lines = get_lines()
     if not lines:
-        print("E:Buffer is empty, nothing to save")
+        error("E:Buffer is empty, nothing to save")
         return
         
     try:
-        with open(filename, "w") as f:
-            for line in lines:
-                f.write(line + "\n")
-        save_state(f"write to file {filename}")
-        set_buffer_file(filename)
-        print(f"Successfully saved {len(lines)} lines to '{filename}'")
+        result = session.save(f"write to file {filename}", filename, incremental=INCREMENTAL_SAVE)
+        if result == "skipped":
+            info(f"'{filename}' is up to date, nothing written")
+            return
+        info(f"Successfully saved {len(lines)} lines to '{filename}'")
     except PermissionError:
-        print(f"E:Permission denied when writing to '{filename}'")
+        error(f"E:Permission denied when writing to '{filename}'")
     except Exception as e:
-        print(f"E:Failed to save to '{filename}': {str(e)}")
+        error(f"E:Failed to save to '{filename}': {str(e)}")
     show_buffer_size()
 
 def clear_buffer():
-    save_state("clear buffer")
-    set_lines([])
-    print("OK")
+    edit_lines("clear buffer", 0, len(get_lines()), [])
+    info("OK")
     show_buffer_size()
 
 def debug():
@@ -196,6 +356,10 @@ def debug():
     print("Platform:", platform.platform())
     #py版本
     print("Python Version:", platform.python_version())
+    index = get_lines().trigram_index
+    if index is not None:
+        print(f"Trigram index: {len(index.postings) + len(index.added)} trigrams, "
+              f"{index.memory() / 1024:.1f} KB, built in {index.build_seconds:.3f}s")
     show_buffer_size()
 
 def about():
@@ -205,114 +369,123 @@ def about():
     print("Type 'q' to quit.")
 
 def switch_buffer(n):
-    global current_buffer
     if n < 0:
-        print("E:Buffer number must be >= 0")
+        error("E:Buffer number must be >= 0")
         return
-    while n >= len(buffers):
-        buffers.append([])
-    while n >= len(buffer_files):
-        buffer_files.append("")
-    current_buffer = n
+    session.switch(n)
     show_buffer_size()
 
 def list_buffers():
     print("Buffers info:")
     for idx, buf in enumerate(buffers):
         fname = get_buffer_file(idx)
-        total_bytes = sum(len(line.encode('utf-8')) + 1 for line in buf)
-        mark = "    <--" if idx == current_buffer else ""
-        print(f"[{idx}] {len(buf)} lines, {total_bytes} bytes, '{fname}' {mark}")
+        line_count, total_bytes, total_chars = buf.stats()
+        mark = "    <--" if idx == session.current else ""
+        print(f"[{idx}] {line_count} lines, {total_bytes} bytes, {total_chars} chars, '{fname}' {mark}")
 
 def remove_buffer(n):
-    global current_buffer
     if n < 0 or n >= len(buffers):
-        print("E:Buffer number out of range")
+        error("E:Buffer number out of range")
         return
     if len(buffers) == 1:
-        print("E:At least one buffer must remain")
+        error("E:At least one buffer must remain")
+        return
+    if session.remove(n):
+        info("OK:switch to buffer 0")
+    info(f"Buffer {n} removed.")
+
+def toggle_trigram_index():
+    """为当前缓冲区建立或删除三元组索引"""
+    lines = get_lines()
+    if lines.trigram_index is not None:
+        lines.trigram_index = None
+        info("Trigram index dropped")
+        return
+    if not isinstance(lines, RopeBuffer):
+        error("E:Trigram index needs the rope buffer engine")
         return
-    buffers.pop(n)
-    buffer_files.pop(n)
-    if current_buffer == n:
-        current_buffer = 0
-        print("OK:switch to buffer 0")
-    elif current_buffer > n:
-        current_buffer -= 1
-    print(f"Buffer {n} removed.")
-
-def search(pattern):
+    lines.trigram_index = TrigramIndex(lines)
+    info(f"Trigram index built in {lines.trigram_index.build_seconds:.3f}s, "
+          f"{lines.trigram_index.memory() / 1024:.1f} KB")
+
+def parse_search_flags(args):
+    """拆出查找/替换命令开头的 -i（忽略大小写）、-w（整词）选项"""
+    ignore_case = whole_word = False
+    parts = args.split(maxsplit=1)
+    if len(parts) == 2 and len(parts[0]) > 1 and parts[0][0] == "-" and set(parts[0][1:]) <= {"i", "w"}:
+        ignore_case = "i" in parts[0]
+        whole_word = "w" in parts[0]
+        args = parts[1]
+    return args, ignore_case, whole_word
+
+def search(pattern, ignore_case=False, whole_word=False):
     import re
     try:
-        regex = re.compile(pattern)
+        matches = parallel_grep([get_lines()], pattern, ignore_case, whole_word)
     except re.error:
-        print("E:Invalid regular expression")
+        error("E:Invalid regular expression")
         return
     
-    lines = get_lines()
-    matches = []
-    for idx, line in enumerate(lines, 1):
-        if regex.search(line):
-            matches.append((idx, line))
-    
     if not matches:
         print("No matches found")
     else:
         print(f"Found {len(matches)} matches:")
-        for idx, line in matches:
-            print(f"{idx}: {line}")
+        for _, idx, line in matches:
+            print(f"{idx + 1}: {line}")
 
-def replace(pattern, replacement):
+def search_all(pattern, ignore_case=False, whole_word=False):
+    """在所有缓冲区中查找"""
     import re
     try:
-        regex = re.compile(pattern)
+        matches = parallel_grep(buffers, pattern, ignore_case, whole_word)
     except re.error:
-        print("E:Invalid regular expression")
+        error("E:Invalid regular expression")
         return
     
-    lines = get_lines()
-    changed = 0
-    for i in range(len(lines)):
-        new_line, count = regex.subn(replacement, lines[i])
-        if count > 0:
-            lines[i] = new_line
-            changed += count
+    if not matches:
+        print("No matches found")
+    else:
+        print(f"Found {len(matches)} matches in {len({buf_idx for buf_idx, _, _ in matches})} buffers:")
+        for buf_idx, idx, line in matches:
+            print(f"[{buf_idx}] {idx + 1}: {line}")
+
+def replace(pattern, replacement, ignore_case=False, whole_word=False):
+    import re
+    try:
+        matcher = get_matcher(pattern, ignore_case, whole_word)
+    except re.error:
+        error("E:Invalid regular expression")
+        return
+    
+    try:
+        changed = session.replace_all(f"replace '{pattern}' with '{replacement}'", matcher, replacement)
+    except re.error:
+        error("E:Invalid replacement")
+        return
     
     if changed > 0:
-        save_state(f"replace '{pattern}' with '{replacement}'")
-        set_lines(lines)
-        print(f"Replaced {changed} occurrences")
+        info(f"Replaced {changed} occurrences")
     else:
-        print("No matches found")
+        info("No matches found")
 
 def undo_last():
     """撤销上一次操作"""
-    if not history:
-        print("E:No more undo history available")
+    delta = session.undo()
+    if delta is None:
+        error("E:No more undo history available")
         return
         
-    global current_buffer
-    buf_idx, buf_content, buf_file = history.pop()
-    redo_history.append((current_buffer, buffers[current_buffer][:], buffer_files[current_buffer]))
-    current_buffer = buf_idx
-    buffers[buf_idx] = buf_content
-    buffer_files[buf_idx] = buf_file
-    print(f"Undo successful, restored buffer {buf_idx} with {len(buf_content)} lines")
+    info(f"Undo successful, restored buffer {session.current} with {len(get_lines())} lines")
     show_buffer_size()
 
 def redo():
     """重做上一次撤销的操作"""
-    if not redo_history:
-        print("E:No more redo history available")
+    delta = session.redo()
+    if delta is None:
+        error("E:No more redo history available")
         return
         
-    global current_buffer
-    buf_idx, buf_content, buf_file = redo_history.pop()
-    history.append((current_buffer, buffers[current_buffer][:], buffer_files[current_buffer]))
-    current_buffer = buf_idx
-    buffers[buf_idx] = buf_content
-    buffer_files[buf_idx] = buf_file
-    print(f"Redo successful, restored buffer {buf_idx} with {len(buf_content)} lines")
+    info(f"Redo successful, restored buffer {session.current} with {len(get_lines())} lines")
     show_buffer_size()
 
 def list_history():
@@ -325,106 +498,287 @@ def list_history():
     for idx, (op, buf_idx) in enumerate(reversed(operation_history[-10:]), 1):
         print(f"{idx}. {op} (buffer {buf_idx})")
 
-def main():
-    print(f"{__mainname__} {__version__}")
-    while True:
-        cmd = input("]").strip()
-        if cmd == "p":
-            p()
-        elif cmd.startswith("s ") and len(cmd) > 2:
-            search(cmd[2:])
-        elif cmd.startswith("r ") and len(cmd.split()) >= 3:
-            parts = cmd[2:].split(maxsplit=1)
-            if len(parts) == 2:
-                replace(parts[0], parts[1])
-            else:
-                print("r pattern replacement  Replace pattern with replacement")
-        elif cmd.startswith("i "):
-            try:
-                n = int(cmd.split()[1])
-                insert(n)
-            except:
-                print("i n  Insert after line n (end with '.')")
-                
-        elif cmd == "a":
-            append()
-        elif cmd.startswith("d "):
-            try:
-                n = int(cmd.split()[1])
-                delete(n)
-            except:
-                print("d n  Delete line n")
-                
-        elif cmd.startswith("w "):
-            filename = cmd[2:].strip()
-            write(filename)
+def execute(cmd, text=None):
+    """执行一条命令，text 是 i/a 命令要插入的文本行（None 表示交互读入）；返回 False 表示退出"""
+    if cmd == "p" or cmd.startswith("p "):
+        p(cmd[1:])
+    elif cmd == "pg" or cmd.startswith("pg "):
+        p(cmd[2:], pager=True)
+    elif cmd.startswith("s ") and len(cmd) > 2:
+        pattern, ignore_case, whole_word = parse_search_flags(cmd[2:])
+        search(pattern, ignore_case, whole_word)
+    elif cmd.startswith("sa ") and len(cmd) > 3:
+        pattern, ignore_case, whole_word = parse_search_flags(cmd[3:])
+        search_all(pattern, ignore_case, whole_word)
+    elif cmd.startswith("r ") and len(cmd.split()) >= 3:
+        args, ignore_case, whole_word = parse_search_flags(cmd[2:])
+        parts = args.split(maxsplit=1)
+        if len(parts) == 2:
+            replace(parts[0], parts[1], ignore_case, whole_word)
+        else:
+            error("r pattern replacement  Replace pattern with replacement")
+    elif cmd.startswith("i "):
+        try:
+            n = int(cmd.split()[1])
+            insert(n, text)
+        except:
+            error("i n  Insert after line n (end with '.')")
             
-        elif cmd.startswith("o "):
-            filename = cmd[2:].strip()
-            if filename:
-                select_file(filename)
-            else:
-                print("o filename   Open file and load to buffer")
-                
-        elif cmd == "c":
-            clear_buffer()
+    elif cmd == "a":
+        append(text)
+    elif cmd.startswith("R "):
+        parts = cmd[2:].split(maxsplit=1)
+        if len(parts) == 2 and (parts[0].isdigit() or parts[0] == "$"):
+            n = None if parts[0] == "$" else int(parts[0])
+            read_file(n, parts[1].strip())
+        elif parts:
+            read_file(None, cmd[2:].strip())
+        else:
+            error("R [n] filename  Read file ('-' for stdin) after line n")
+    elif cmd.startswith("d "):
+        try:
+            n = int(cmd.split()[1])
+            delete(n)
+        except:
+            error("d n  Delete line n")
+            
+    elif cmd.startswith("w "):
+        filename = cmd[2:].strip()
+        write(filename)
         
-        elif cmd.startswith("s "):
+    elif cmd.startswith("o "):
+        filename = cmd[2:].strip()
+        if filename:
+            select_file(filename)
+        else:
+            error("o filename   Open file and load to buffer")
+    elif cmd.startswith("om "):
+        filename = cmd[3:].strip()
+        if filename:
+            select_file_mapped(filename)
+        else:
+            error("om filename  Open large file lazily (memory-mapped)")
+            
+    elif cmd == "c":
+        clear_buffer()
+    
+    elif cmd.startswith("s "):
+        try:
+            n = int(cmd.split()[1])
+            switch_buffer(n)
+        except:
+            error("s n  Switch buffer (0~N)")
+    elif cmd.startswith("r "):
+        try:
+            n = int(cmd.split()[1])
+            remove_buffer(n)
+        except:
+            error("r n  Remove buffer n")
+            
+    elif cmd.startswith("u "):
+        args = cmd.split()
+        if len(args) == 2 and args[1] == "c":
+            clear_buffer()
+        elif len(args) == 2 and args[1] == "l":
+            list_buffers()
+        elif len(args) == 2 and args[1] == "z":
+            undo_last()
+        elif len(args) == 2 and args[1] == "y":
+            redo()
+        elif len(args) == 2 and args[1] == "h":
+            list_history()
+        elif len(args) == 2 and args[1] == "t":
+            toggle_trigram_index()
+        elif len(args) == 3 and args[1] == "s":
             try:
-                n = int(cmd.split()[1])
+                n = int(args[2])
                 switch_buffer(n)
             except:
-                print("s n  Switch buffer (0~N)")
-        elif cmd.startswith("r "):
+                error("u s [n]  Switch buffer (0~N)")
+        elif len(args) == 3 and args[1] == "r":
             try:
-                n = int(cmd.split()[1])
+                n = int(args[2])
                 remove_buffer(n)
             except:
-                print("r n  Remove buffer n")
-                
-        elif cmd.startswith("u "):
-            args = cmd.split()
-            if len(args) == 2 and args[1] == "c":
-                clear_buffer()
-            elif len(args) == 2 and args[1] == "l":
-                list_buffers()
-            elif len(args) == 2 and args[1] == "z":
-                undo_last()
-            elif len(args) == 2 and args[1] == "y":
-                redo()
-            elif len(args) == 2 and args[1] == "h":
-                list_history()
-            elif len(args) == 3 and args[1] == "s":
-                try:
-                    n = int(args[2])
-                    switch_buffer(n)
-                except:
-                    print("u s [n]  Switch buffer (0~N)")
-            elif len(args) == 3 and args[1] == "r":
-                try:
-                    n = int(args[2])
-                    remove_buffer(n)
-                except:
-                    print("u r n  Remove buffer n")
-            else:
-                print("u c  Clear buffer | u s [n]  Switch buffer | u r [n]  Remove buffer n | u z Undo | u y Redo | u h History")
-                
-        elif cmd == "l":
-            list_buffers()
-        elif cmd == "q":
-            print("Bye!")
-            break
-        elif cmd == "h":
-            print_help()
-        elif cmd == "b":
-            debug()
-        elif cmd == "v":
-            about()
-        elif cmd == "c":
-            clear_buffer()
+                error("u r n  Remove buffer n")
+        else:
+            error("u c  Clear buffer | u s [n]  Switch buffer | u r [n]  Remove buffer n | u z Undo | u y Redo | u h History | u t Trigram index")
+            
+    elif cmd == "l":
+        list_buffers()
+    elif cmd == "q":
+        info("Bye!")
+        return False
+    elif cmd == "h":
+        print_help()
+    elif cmd == "b":
+        debug()
+    elif cmd == "v":
+        about()
+    elif cmd == "c":
+        clear_buffer()
+    else:
+        error("E:Unknown command, enter h for help.")
+        show_buffer_size()
+    return True
+
+def parse_script(source):
+    """把脚本解析成 [(命令, 文本行)]；i/a 命令之后直到单独一行 '.' 的内容是要插入的文本
+
+    空行和 # 开头的行忽略。
+    """
+    commands = []
+    source = iter(source)
+    for raw in source:
+        cmd = raw.rstrip("\r\n").strip()
+        if not cmd or cmd.startswith("#"):
+            continue
+        text = None
+        if cmd == "a" or cmd.startswith("i "):
+            text = []
+            for raw_text in source:
+                raw_text = raw_text.rstrip("\r\n")
+                if raw_text == ".":
+                    break
+                text.append(raw_text)
+        commands.append((cmd, text))
+    return commands
+
+def dump_buffer(out):
+    """把当前缓冲区按大块原样写到 out（不带行号）"""
+    for chunk in get_lines().iter_chunks():
+        out.write("".join([line + "\n" for line in chunk]))
+    out.flush()
+
+def run_script(script, filename=None, output=None):
+    """批处理模式：先解析整个脚本再逐条执行，不提示也不输出缓冲区大小
+
+    遇到第一个出错的命令即停止。output 为 '-' 时把结果写到 stdout。
+    返回退出码：0 成功，1 命令出错，2 脚本无法读取。
+    """
+    global QUIET
+    QUIET = True
+    try:
+        if script == "-":
+            commands = parse_script(sys.stdin)
         else:
-            print("E:Unknown command, enter h for help.")
-            show_buffer_size()
+            with open(script, "r", encoding="utf-8") as f:
+                commands = parse_script(f)
+    except OSError as e:
+        error(f"E:Failed to read script '{script}': {e}")
+        return 2
+    if filename:
+        select_file(filename)
+        if error_count:
+            return 1
+    for lineno, (cmd, text) in enumerate(commands, 1):
+        if not execute(cmd, text):
+            break
+        if error_count:
+            error(f"E:Script stopped at command {lineno}: {cmd}")
+            return 1
+    if output == "-":
+        dump_buffer(sys.stdout)
+    elif output:
+        write(output)
+    return 1 if error_count else 0
+
+def load_session_file(filename):
+    """恢复会话；磁盘上已改变的文件对应的缓冲区恢复为空"""
+    try:
+        stale = restore_session(session, filename)
+    except (OSError, ValueError) as e:
+        error(f"E:Failed to restore session '{filename}': {e}")
+        return
+    for name in stale:
+        info(f"File '{name}' changed on disk, its buffer was not restored")
+    info(f"Session '{filename}' restored, {len(buffers)} buffers")
+
+def save_session_file(filename):
+    try:
+        save_session(session, filename)
+        info(f"Session saved to '{filename}'")
+    except Exception as e:
+        error(f"E:Failed to save session '{filename}': {e}")
+
+def start_journal(filename, fsync):
+    """重放上次异常退出留下的日志，然后从当前状态开始记新的日志"""
+    try:
+        count, stale, problem = replay_journal(session, filename)
+        for name in stale:
+            info(f"File '{name}' changed on disk, its buffer was not recovered")
+        if problem:
+            error(f"E:Journal replay stopped at {problem}")
+        if count:
+            info(f"Recovered {count} changes from journal '{filename}'")
+        journal = Journal(filename, fsync)
+        journal.checkpoint(session)
+    except (OSError, ValueError) as e:
+        error(f"E:Failed to open journal '{filename}': {e}")
+        return
+    session.journal = journal
+
+def stop_journal():
+    """正常退出：改动已经处理完，删除日志"""
+    if session.journal is not None:
+        session.journal.close(remove=True)
+        session.journal = None
+
+def parse_fsync(value):
+    if value in ("always", "never"):
+        return value
+    try:
+        ms = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected 'always', 'never' or milliseconds")
+    if ms <= 0:
+        raise argparse.ArgumentTypeError("milliseconds must be positive")
+    return ms
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog=__mainname__.lower(), description="A simple line editor, similar to Linux's ed editor.")
+    parser.add_argument("-s", "--script", metavar="SCRIPT", help="run commands from SCRIPT ('-' for stdin) without prompts, then exit")
+    parser.add_argument("-o", "--output", metavar="FILE", help="after the script, write the current buffer to FILE ('-' for stdout)")
+    parser.add_argument("--session", metavar="FILE", help="restore buffers and history from FILE if it exists, and save them back on exit")
+    parser.add_argument("--journal", metavar="FILE", help="log changes to FILE for crash recovery and replay it on start")
+    parser.add_argument("--fsync", metavar="POLICY", type=parse_fsync, default=JOURNAL_FSYNC_MS,
+                        help=f"when the journal reaches disk: always, never or every MS milliseconds (default {JOURNAL_FSYNC_MS})")
+    parser.add_argument("file", nargs="?", help="file to open first")
+    args = parser.parse_args(argv)
+    # 文件按 surrogateescape 解码，行里可能带着坏字节；终端默认严格编码，输出时会抛异常把编辑器弄崩，
+    # 这里让 p/s 和 -o - 把这些字节原样写出去
+    if hasattr(sys.stdout, "reconfigure"):
+        sys.stdout.reconfigure(errors="surrogateescape")
+    if args.output and not args.script:
+        parser.error("-o/--output needs -s/--script")
+    if args.script:
+        global QUIET
+        QUIET = True
+    if args.session and os.path.exists(args.session):
+        load_session_file(args.session)
+        if error_count:
+            return 1
+    if args.journal:
+        start_journal(args.journal, args.fsync)
+        if error_count and args.script:
+            return 1
+    if args.script:
+        code = run_script(args.script, args.file, args.output)
+    else:
+        print(f"{__mainname__} {__version__}")
+        if args.file:
+            select_file(args.file)
+        while True:
+            if session.journal is not None:
+                session.journal.flush()  # 等待输入前把攒着的记录写出去
+            cmd = input("]").strip()
+            if not execute(cmd):
+                break
+        code = 0
+    if args.session:
+        save_session_file(args.session)
+    stop_journal()
+    return code
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
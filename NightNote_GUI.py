@@ -1,8 +1,22 @@
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, simpledialog
 from tkinter.scrolledtext import ScrolledText
+import os
 import platform
 import re
+import threading
+from nightnote_core import (Session, TextFile, get_matcher, is_literal, lines_to_text, mark_loaded,
+                            restore_session, save_session, text_edits)
+
+# 后台保存时每隔多少毫秒检查一次是否写完（Tk 不能从其他线程回调）
+SAVE_POLL_MS = 50
+# 高亮可见区域的匹配时每次 after() 回调最多标记多少处，滚动、编辑后延迟多久重新标记
+SEARCH_TAG_BATCH = 200
+SEARCH_RETAG_MS = 100
+# 打开文件时每次空闲回调读入、解码并插入的字节数
+LOAD_CHUNK_BYTES = 256 * 1024
+# 退出时保存、启动时恢复的会话文件
+SESSION_FILE = os.path.join(os.path.expanduser("~"), ".nightnote_tk.session")
 
 class NightNoteGUI:
     def __init__(self, root):
@@ -15,15 +29,19 @@ class NightNoteGUI:
         self.__author__ = "DONGFANG Lingye"
         self.__email__ = "ly@lingye.online"
         
-        # 多缓冲区支持
-        self.buffers = [""]
-        self.buffer_files = [""]
-        self.current_buffer = 0
-        
-        # 历史记录
-        self.history = []
-        self.redo_history = []
-        self.MAX_HISTORY = 10
+        # 多缓冲区和历史记录都交给编辑核心，文本框里只有当前缓冲区的一份文本
+        self.session = Session()
+        self.save_thread = None  # 后台保存的线程和对应的 SaveJob
+        self.save_job = None
+        # 查找模式：(模式, 是否正则)；只标记可见区域，标记任务分批在 after() 里执行
+        self.search_pattern = None
+        self.search_job = None
+        self.retag_job = None
+        # 分块加载状态：打开的文件、按块产出行的迭代器、已读入的行
+        self.load_file = None
+        self.load_chunks = None
+        self.load_lines = []
+        self.load_job = None
         
         # 样式配置
         self.setup_styles()
@@ -33,8 +51,10 @@ class NightNoteGUI:
         self.create_toolbar()
         self.create_text_area()
         self.create_status_bar()
+        self.root.protocol("WM_DELETE_WINDOW", self.quit_app)
         
         # 初始状态
+        self.restore_last_session()
         self.update_title()
         self.update_status()
     
@@ -63,7 +83,7 @@ class NightNoteGUI:
         file_menu.add_command(label="保存", command=self.save_file, accelerator="Ctrl+S")
         file_menu.add_command(label="另存为...", command=self.save_as, accelerator="Ctrl+Shift+S")
         file_menu.add_separator()
-        file_menu.add_command(label="退出", command=self.root.quit, accelerator="Alt+F4")
+        file_menu.add_command(label="退出", command=self.quit_app, accelerator="Alt+F4")
         menubar.add_cascade(label="文件", menu=file_menu)
         
         # 编辑菜单
@@ -72,6 +92,9 @@ class NightNoteGUI:
         edit_menu.add_command(label="重做", command=self.redo, accelerator="Ctrl+Y")
         edit_menu.add_separator()
         edit_menu.add_command(label="查找", command=self.search_text, accelerator="Ctrl+F")
+        edit_menu.add_command(label="查找下一个", command=self.find_next, accelerator="F3")
+        edit_menu.add_command(label="查找上一个", command=self.find_previous, accelerator="Shift+F3")
+        edit_menu.add_command(label="清除高亮", command=self.clear_highlight, accelerator="Esc")
         edit_menu.add_command(label="替换", command=self.replace_text, accelerator="Ctrl+H")
         menubar.add_cascade(label="编辑", menu=edit_menu)
         
@@ -120,6 +143,11 @@ class NightNoteGUI:
                                font=('Consolas', 11), bg=self.text_bg, fg=self.text_fg,
                                insertbackground='black', selectbackground='#4a98e9')
         self.text.pack(fill=tk.BOTH, expand=True)
+        self.text.tag_config("search", background="yellow")
+        self.text.tag_raise("sel")
+        # 视图变化（滚动、缩放、编辑）后重新标记可见区域的匹配
+        self.text.configure(yscrollcommand=self.on_yscroll)
+        self.text.bind("<KeyRelease>", lambda e: self.schedule_highlight(), add="+")
         
         # 绑定快捷键
         self.text.bind("<Control-n>", lambda e: self.new_file())
@@ -129,6 +157,9 @@ class NightNoteGUI:
         self.text.bind("<Control-z>", lambda e: self.undo_last())
         self.text.bind("<Control-y>", lambda e: self.redo())
         self.text.bind("<Control-f>", lambda e: self.search_text())
+        self.text.bind("<F3>", lambda e: self.find_next())
+        self.text.bind("<Shift-F3>", lambda e: self.find_previous())
+        self.text.bind("<Escape>", lambda e: self.clear_highlight())
         self.text.bind("<Control-h>", lambda e: self.replace_text())
         self.text.bind("<Control-b>", lambda e: self.new_buffer())
         self.text.bind("<Control-Tab>", lambda e: self.switch_buffer())
@@ -147,144 +178,357 @@ class NightNoteGUI:
         self.buffer_var = tk.StringVar()
         ttk.Label(status_frame, textvariable=self.buffer_var, 
                  style='Status.TLabel').pack(side=tk.RIGHT, padx=5)
+        
+        # 加载进度和取消按钮，只在分块加载时显示
+        self.progress = ttk.Progressbar(status_frame, length=200, maximum=100)
+        self.cancel_button = ttk.Button(status_frame, text="取消", command=self.cancel_load)
+    
+    def restore_last_session(self):
+        """恢复上次退出时的会话，只把当前缓冲区放进文本框"""
+        if not os.path.exists(SESSION_FILE):
+            return
+        try:
+            stale = restore_session(self.session, SESSION_FILE)
+        except (OSError, ValueError) as e:
+            messagebox.showwarning("会话", f"无法恢复会话: {str(e)}")
+            return
+        self.show_buffer()
+        if stale:
+            messagebox.showinfo("会话", "以下文件在磁盘上已改变，对应的缓冲区没有恢复:\n" + "\n".join(stale))
+    
+    def quit_app(self):
+        """等后台保存写完，把会话存下来再退出"""
+        if self.load_file is not None:
+            self.cancel_load()
+        if self.save_thread is not None:
+            self.save_thread.join()
+            self.end_save()  # 收尾之后缓冲区才知道自己已经改存为新文件
+        self.sync_buffer()
+        try:
+            save_session(self.session, SESSION_FILE)
+        except Exception as e:
+            messagebox.showerror("错误", f"无法保存会话: {str(e)}")
+        self.root.destroy()
     
     def update_title(self):
-        filename = self.buffer_files[self.current_buffer]
+        filename = self.session.filename
         title = f"{self.__mainname__} {self.__version__}"
         if filename:
             title += f" - {filename}"
         self.root.title(title)
     
     def update_status(self):
-        text = self.buffers[self.current_buffer]
-        lines = len(text.split('\n')) if text else 0
-        size = len(text.encode('utf-8')) if text else 0
+        lines, size, _ = self.session.buffer.stats()
         self.status_var.set(f"行数: {lines} | 大小: {size} 字节")
-        self.buffer_var.set(f"缓冲区: {self.current_buffer}/{len(self.buffers)-1}")
+        self.buffer_var.set(f"缓冲区: {self.session.current}/{len(self.session.buffers)-1}")
     
-    def save_state(self, operation):
-        """保存当前状态到历史记录"""
-        if len(self.history) >= self.MAX_HISTORY:
-            self.history.pop(0)
-        self.history.append((self.current_buffer, self.buffers[self.current_buffer], 
-                          self.buffer_files[self.current_buffer]))
-        self.redo_history.clear()
+    def sync_buffer(self):
+        """文本框改动过时把变化的行同步进编辑核心，作为一条可撤销的历史"""
+        if self.text.edit_modified():
+            self.session.sync(self.text.get("1.0", "end-1c"), "编辑")
+            self.text.edit_modified(False)
     
-    # 以下是各个功能的实现 (保持不变)
-    def new_file(self):
-        self.save_state("新建文件")
-        self.buffers[self.current_buffer] = ""
-        self.buffer_files[self.current_buffer] = ""
+    def show_buffer(self):
+        """把当前缓冲区显示到文本框"""
         self.text.delete(1.0, tk.END)
+        self.text.insert(tk.END, lines_to_text(self.session.buffer))
+        self.text.edit_reset()
+        self.text.edit_modified(False)
+        self.update_title()
+        self.update_status()
+        self.schedule_highlight()
+    
+    def apply_last_edit(self, shown):
+        """只把编辑核心最近一次修改涉及的文本改进文本框，保留滚动位置；
+        改的不是 shown（原来显示的缓冲区）时整体重新显示"""
+        buf_idx, changes = self.session.last_edit
+        if buf_idx != shown:
+            self.show_buffer()
+            return
+        self.text.configure(undo=False)
+        for line1, col1, line2, col2, text in text_edits(changes, len(self.session.buffer)):
+            start = f"{line1 + 1}.{'end' if col1 is None else col1}"
+            self.text.delete(start, f"{line2 + 1}.{'end' if col2 is None else col2}")
+            if text:
+                self.text.insert(start, text)
+        self.text.configure(undo=True)
+        self.text.edit_reset()
+        self.text.edit_modified(False)
         self.update_title()
         self.update_status()
+        self.schedule_highlight()
+    
+    # 以下是各个功能的实现 (保持不变)
+    def new_file(self):
+        self.sync_buffer()
+        self.session.edit("新建文件", 0, len(self.session.buffer), [], filename="")
+        self.show_buffer()
     
     def open_file(self):
+        """在空闲回调里分块读入并插入文本框，界面在加载期间保持响应"""
         filename = filedialog.askopenfilename()
-        if filename:
-            try:
-                with open(filename, 'r') as f:
-                    content = f.read()
-                self.save_state(f"打开文件 {filename}")
-                self.buffers[self.current_buffer] = content
-                self.buffer_files[self.current_buffer] = filename
-                self.text.delete(1.0, tk.END)
-                self.text.insert(tk.END, content)
-                self.update_title()
-                self.update_status()
-            except Exception as e:
-                messagebox.showerror("错误", f"无法打开文件: {str(e)}")
-    
-    def save_file(self):
-        if not self.buffer_files[self.current_buffer]:
-            self.save_as()
+        if not filename:
             return
-        
         try:
-            content = self.text.get(1.0, tk.END)
-            with open(self.buffer_files[self.current_buffer], 'w') as f:
-                f.write(content)
-            self.save_state(f"保存文件 {self.buffer_files[self.current_buffer]}")
-            self.buffers[self.current_buffer] = content
-            messagebox.showinfo("保存", "文件保存成功")
+            # 从开头一块探测编码，之后按块增量解码，坏字节原样保留
+            self.load_file = TextFile(filename, size=LOAD_CHUNK_BYTES)
+        except Exception as e:
+            messagebox.showerror("错误", f"无法打开文件: {str(e)}")
+            return
+        self.sync_buffer()
+        self.load_filename = filename
+        self.load_chunks = iter(self.load_file)
+        self.load_lines = []
+        # 加载期间关闭自动换行和撤销记录，每块插入不必重排、不进撤销栈
+        self.text.configure(wrap=tk.NONE, undo=False)
+        self.text.delete("1.0", tk.END)
+        self.text.configure(state=tk.DISABLED)
+        self.progress["value"] = 0
+        self.cancel_button.pack(side=tk.RIGHT, padx=5)
+        self.progress.pack(side=tk.RIGHT, padx=5)
+        # 加载期间只让取消按钮接收输入
+        self.cancel_button.focus_set()
+        self.cancel_button.grab_set()
+        self.load_job = self.root.after_idle(self.load_chunk)
+    
+    def load_chunk(self):
+        """读入一块并追加到文本框末尾，然后把下一块排进空闲回调"""
+        try:
+            lines = next(self.load_chunks, None)
+        except Exception as e:
+            self.finish_load(f"无法打开文件: {str(e)}")
+            return
+        if lines is None:
+            self.finish_load()
+            return
+        text = "\n".join(lines)
+        self.text.configure(state=tk.NORMAL)
+        self.text.insert("end-1c", "\n" + text if self.load_lines else text)
+        self.text.configure(state=tk.DISABLED)
+        self.load_lines.extend(lines)
+        percent = self.load_file.tell() * 100 // max(self.load_file.stat.st_size, 1)
+        self.progress["value"] = percent
+        self.status_var.set(f"正在加载: {percent}% | 行数: {len(self.load_lines)}")
+        self.load_job = self.root.after_idle(self.load_chunk)
+    
+    def cancel_load(self):
+        if self.load_file is not None:
+            self.root.after_cancel(self.load_job)
+            self.finish_load(cancelled=True)
+    
+    def finish_load(self, error=None, cancelled=False):
+        """加载结束：成功时把读入的行一次性交给编辑核心，失败或取消时恢复原来的内容"""
+        load_file, self.load_file = self.load_file, None
+        load_file.close()
+        self.load_chunks = None
+        self.load_job = None
+        lines, self.load_lines = self.load_lines, []
+        self.cancel_button.grab_release()
+        self.progress.pack_forget()
+        self.cancel_button.pack_forget()
+        self.text.configure(state=tk.NORMAL, wrap=tk.WORD, undo=True)
+        self.text.focus_set()
+        if error is None and not cancelled:
+            filename = self.load_filename
+            self.session.edit(f"打开文件 {filename}", 0, len(self.session.buffer), lines, filename=filename)
+            mark_loaded(self.session.buffer, filename, load_file.encoding, load_file.stat, load_file.newline)
+            self.text.edit_reset()
+            self.text.edit_modified(False)
+            self.update_title()
             self.update_status()
+            self.schedule_highlight()
+        else:
+            self.show_buffer()
+            if error is not None:
+                messagebox.showerror("错误", error)
+    
+    def write_buffer(self, filename, operation):
+        """同步后只给缓冲区拍快照，编码和写盘（临时文件 + fsync + 改名）放到后台线程"""
+        if self.save_thread is not None:
+            messagebox.showinfo("保存", "上一次保存尚未完成")
+            return
+        self.sync_buffer()
+        job = self.session.start_save(operation, filename)
+        # 不设为守护线程，退出时也会等文件写完
+        self.save_thread = threading.Thread(target=job.run)
+        self.save_job = job
+        self.save_thread.start()
+        self.status_var.set("正在保存...")
+        self.root.after(SAVE_POLL_MS, self.poll_save)
+    
+    def end_save(self):
+        """后台保存写完后在界面线程收尾，失败时报告错误并返回 False"""
+        job = self.save_job
+        self.save_thread = None
+        self.save_job = None
+        try:
+            self.session.finish_save(job)
         except Exception as e:
+            self.update_status()
             messagebox.showerror("错误", f"无法保存文件: {str(e)}")
+            return False
+        return True
+    
+    def poll_save(self):
+        """写完后回到界面线程收尾并报告结果"""
+        if self.save_thread is None:
+            return
+        if self.save_thread.is_alive():
+            self.root.after(SAVE_POLL_MS, self.poll_save)
+            return
+        if not self.end_save():
+            return
+        self.update_title()
+        self.update_status()
+        messagebox.showinfo("保存", "文件保存成功")
+    
+    def save_file(self):
+        if not self.session.filename:
+            self.save_as()
+            return
+        
+        self.write_buffer(self.session.filename, f"保存文件 {self.session.filename}")
     
     def save_as(self):
         filename = filedialog.asksaveasfilename()
         if filename:
-            try:
-                content = self.text.get(1.0, tk.END)
-                with open(filename, 'w') as f:
-                    f.write(content)
-                self.save_state(f"另存为 {filename}")
-                self.buffers[self.current_buffer] = content
-                self.buffer_files[self.current_buffer] = filename
-                self.update_title()
-                self.update_status()
-                messagebox.showinfo("保存", "文件保存成功")
-            except Exception as e:
-                messagebox.showerror("错误", f"无法保存文件: {str(e)}")
+            self.write_buffer(filename, f"另存为 {filename}")
     
     def undo_last(self):
-        if not self.history:
+        self.sync_buffer()
+        shown = self.session.current
+        delta = self.session.undo()
+        if delta is None:
             messagebox.showinfo("撤销", "没有可撤销的操作")
             return
         
-        buf_idx, buf_content, buf_file = self.history.pop()
-        self.redo_history.append((self.current_buffer, self.buffers[self.current_buffer], 
-                                self.buffer_files[self.current_buffer]))
-        self.current_buffer = buf_idx
-        self.buffers[buf_idx] = buf_content
-        self.buffer_files[buf_idx] = buf_file
-        self.text.delete(1.0, tk.END)
-        self.text.insert(tk.END, buf_content)
-        self.update_title()
-        self.update_status()
-        messagebox.showinfo("撤销", f"已撤销操作，恢复缓冲区 {buf_idx}")
+        self.apply_last_edit(shown)
+        messagebox.showinfo("撤销", f"已撤销操作，恢复缓冲区 {delta.buf_idx}")
     
     def redo(self):
-        if not self.redo_history:
+        self.sync_buffer()
+        shown = self.session.current
+        delta = self.session.redo()
+        if delta is None:
             messagebox.showinfo("重做", "没有可重做的操作")
             return
         
-        buf_idx, buf_content, buf_file = self.redo_history.pop()
-        self.history.append((self.current_buffer, self.buffers[self.current_buffer], 
-                           self.buffer_files[self.current_buffer]))
-        self.current_buffer = buf_idx
-        self.buffers[buf_idx] = buf_content
-        self.buffer_files[buf_idx] = buf_file
-        self.text.delete(1.0, tk.END)
-        self.text.insert(tk.END, buf_content)
-        self.update_title()
-        self.update_status()
-        messagebox.showinfo("重做", f"已重做操作，恢复缓冲区 {buf_idx}")
+        self.apply_last_edit(shown)
+        messagebox.showinfo("重做", f"已重做操作，恢复缓冲区 {delta.buf_idx}")
     
     def search_text(self):
-        pattern = simpledialog.askstring("查找", "输入要查找的内容:")
-        if pattern:
-            content = self.text.get(1.0, tk.END)
-            try:
-                regex = re.compile(pattern)
-                matches = [m for m in regex.finditer(content)]
-                
-                if not matches:
-                    messagebox.showinfo("查找", "未找到匹配内容")
-                else:
-                    # 高亮显示第一个匹配项
-                    first_match = matches[0]
-                    start = f"1.0 + {first_match.start()} chars"
-                    end = f"1.0 + {first_match.end()} chars"
-                    self.text.tag_add("search", start, end)
-                    self.text.tag_config("search", background="yellow")
-                    self.text.see(start)
-                    messagebox.showinfo("查找", f"找到 {len(matches)} 处匹配")
-            except re.error:
-                messagebox.showerror("错误", "无效的正则表达式")
+        """在文本框里直接用 Tk 的 search 从插入点查找，不再取出整份文本"""
+        # 查找由 Tk 在文本框里做，替换由编辑核心做，两边的正则语法不同，提示里写明
+        pattern = simpledialog.askstring("查找", "输入要查找的内容（正则为 Tcl 语法，不支持后行断言等）:")
+        if not pattern:
+            return
+        try:
+            # 不含正则元字符时按字面查找，否则交给 Tk 的正则（Tcl ARE 语法），是否有效由 Tk 判断
+            regexp = not is_literal(pattern)
+            self.text.search(pattern, "1.0", stopindex="1.0", regexp=regexp)
+        except tk.TclError:
+            messagebox.showerror("错误", "无效的正则表达式（查找使用 Tcl 正则语法）")
+            return
+        self.search_pattern = (pattern, regexp)
+        if self.find_next():
+            self.schedule_highlight()
+        else:
+            self.clear_highlight()
+            messagebox.showinfo("查找", "未找到匹配内容")
+    
+    def find_match(self, start, backwards=False):
+        """从 start 开始找下一处（或上一处）匹配，到头后回绕；返回 (起点, 终点) 或 None"""
+        pattern, regexp = self.search_pattern
+        count = tk.IntVar()
+        index = self.text.search(pattern, start, forwards=not backwards, backwards=backwards,
+                                 regexp=regexp, count=count)
+        if not index:
+            return None
+        return index, f"{index}+{count.get()}c"
+    
+    def select_match(self, match):
+        start, end = match
+        self.text.tag_remove("sel", "1.0", tk.END)
+        self.text.tag_add("sel", start, end)
+        self.text.mark_set("insert", end)
+        self.text.see(start)
+    
+    def find_next(self):
+        """从选区末尾（没有选区时从插入点）向后查找"""
+        if self.search_pattern is None:
+            self.search_text()
+            return None
+        start = "sel.last" if self.text.tag_ranges("sel") else "insert"
+        match = self.find_match(self.text.index(start))
+        if match is None:
+            self.status_var.set("未找到匹配内容")
+            return None
+        self.select_match(match)
+        return match
+    
+    def find_previous(self):
+        """从选区起点（没有选区时从插入点）向前查找"""
+        if self.search_pattern is None:
+            self.search_text()
+            return None
+        start = "sel.first" if self.text.tag_ranges("sel") else "insert"
+        match = self.find_match(self.text.index(start), backwards=True)
+        if match is None:
+            self.status_var.set("未找到匹配内容")
+            return None
+        self.select_match(match)
+        return match
+    
+    def on_yscroll(self, first, last):
+        self.text.vbar.set(first, last)
+        self.schedule_highlight()
+    
+    def schedule_highlight(self):
+        """合并连续的滚动、编辑，稍后重新标记一次"""
+        if self.search_pattern is None or self.load_file is not None:
+            return
+        if self.retag_job is not None:
+            self.root.after_cancel(self.retag_job)
+        self.retag_job = self.root.after(SEARCH_RETAG_MS, self.highlight_visible)
+    
+    def highlight_visible(self):
+        """清掉旧标记，然后分批标记可见范围内的所有匹配"""
+        self.retag_job = None
+        if self.search_job is not None:
+            self.root.after_cancel(self.search_job)
+            self.search_job = None
+        self.text.tag_remove("search", "1.0", tk.END)
+        if self.search_pattern is None:
+            return
+        start = self.text.index("@0,0 linestart")
+        stop = self.text.index(f"@0,{self.text.winfo_height()} lineend")
+        self.tag_batch(start, stop)
+    
+    def tag_batch(self, start, stop):
+        pattern, regexp = self.search_pattern
+        count = tk.IntVar()
+        for _ in range(SEARCH_TAG_BATCH):
+            index = self.text.search(pattern, start, stopindex=stop, regexp=regexp, count=count)
+            if not index:
+                self.search_job = None
+                return
+            length = count.get()
+            start = f"{index}+{max(length, 1)}c"  # 空匹配时向前挪一个字符
+            if length:
+                self.text.tag_add("search", index, start)
+        self.search_job = self.root.after_idle(self.tag_batch, self.text.index(start), stop)
+    
+    def clear_highlight(self):
+        self.search_pattern = None
+        for job in (self.search_job, self.retag_job):
+            if job is not None:
+                self.root.after_cancel(job)
+        self.search_job = None
+        self.retag_job = None
+        self.text.tag_remove("search", "1.0", tk.END)
     
     def replace_text(self):
-        pattern = simpledialog.askstring("替换", "输入要查找的内容:")
+        pattern = simpledialog.askstring("替换", "输入要查找的内容（正则为 Python re 语法）:")
         if not pattern:
             return
             
@@ -292,16 +536,12 @@ class NightNoteGUI:
         if replacement is None:
             return
             
-        content = self.text.get(1.0, tk.END)
+        self.sync_buffer()
         try:
-            regex = re.compile(pattern)
-            new_content, count = regex.subn(replacement, content)
+            count = self.session.replace_all(f"替换 '{pattern}' 为 '{replacement}'", get_matcher(pattern), replacement)
             
             if count > 0:
-                self.save_state(f"替换 '{pattern}' 为 '{replacement}'")
-                self.buffers[self.current_buffer] = new_content
-                self.text.delete(1.0, tk.END)
-                self.text.insert(tk.END, new_content)
+                self.apply_last_edit(self.session.current)
                 messagebox.showinfo("替换", f"替换了 {count} 处")
             else:
                 messagebox.showinfo("替换", "未找到匹配内容")
@@ -309,59 +549,42 @@ class NightNoteGUI:
             messagebox.showerror("错误", "无效的正则表达式")
     
     def new_buffer(self):
-        self.save_state("新建缓冲区")
-        self.buffers.append("")
-        self.buffer_files.append("")
-        self.current_buffer = len(self.buffers) - 1
-        self.text.delete(1.0, tk.END)
-        self.update_title()
-        self.update_status()
-        messagebox.showinfo("缓冲区", f"已创建新缓冲区 {self.current_buffer}")
+        self.sync_buffer()
+        self.session.new_buffer()
+        self.show_buffer()
+        messagebox.showinfo("缓冲区", f"已创建新缓冲区 {self.session.current}")
     
     def switch_buffer(self):
         buf_num = simpledialog.askinteger("切换缓冲区", 
-                                         f"输入缓冲区编号 (0-{len(self.buffers)-1}):")
-        if buf_num is not None and 0 <= buf_num < len(self.buffers):
-            self.save_state(f"切换到缓冲区 {buf_num}")
-            self.current_buffer = buf_num
-            self.text.delete(1.0, tk.END)
-            self.text.insert(tk.END, self.buffers[buf_num])
-            self.update_title()
-            self.update_status()
+                                         f"输入缓冲区编号 (0-{len(self.session.buffers)-1}):")
+        if buf_num is not None and 0 <= buf_num < len(self.session.buffers):
+            self.sync_buffer()
+            self.session.switch(buf_num)
+            self.show_buffer()
         elif buf_num is not None:
             messagebox.showerror("错误", "无效的缓冲区编号")
     
     def remove_buffer(self):
-        if len(self.buffers) == 1:
+        if len(self.session.buffers) == 1:
             messagebox.showerror("错误", "必须保留至少一个缓冲区")
             return
             
         buf_num = simpledialog.askinteger("删除缓冲区", 
-                                         f"输入要删除的缓冲区编号 (0-{len(self.buffers)-1}):")
-        if buf_num is not None and 0 <= buf_num < len(self.buffers):
-            self.save_state(f"删除缓冲区 {buf_num}")
-            self.buffers.pop(buf_num)
-            self.buffer_files.pop(buf_num)
-            
-            if self.current_buffer == buf_num:
-                self.current_buffer = 0
-            elif self.current_buffer > buf_num:
-                self.current_buffer -= 1
-                
-            self.text.delete(1.0, tk.END)
-            self.text.insert(tk.END, self.buffers[self.current_buffer])
-            self.update_title()
-            self.update_status()
+                                         f"输入要删除的缓冲区编号 (0-{len(self.session.buffers)-1}):")
+        if buf_num is not None and 0 <= buf_num < len(self.session.buffers):
+            self.sync_buffer()
+            self.session.remove(buf_num)
+            self.show_buffer()
             messagebox.showinfo("删除", f"已删除缓冲区 {buf_num}")
         elif buf_num is not None:
             messagebox.showerror("错误", "无效的缓冲区编号")
     
     def list_buffers(self):
+        self.sync_buffer()
         info = "缓冲区列表:\n"
-        for idx, (buf, fname) in enumerate(zip(self.buffers, self.buffer_files)):
-            size = len(buf.encode('utf-8'))
-            lines = len(buf.split('\n'))
-            mark = " <-- 当前" if idx == self.current_buffer else ""
+        for idx, (buf, fname) in enumerate(zip(self.session.buffers, self.session.buffer_files)):
+            lines, size, _ = buf.stats()
+            mark = " <-- 当前" if idx == self.session.current else ""
             info += f"[{idx}] {lines} 行, {size} 字节, '{fname}'{mark}\n"
         messagebox.showinfo("缓冲区列表", info)
     
@@ -382,6 +605,8 @@ Ctrl+Shift+S: 另存为
 Ctrl+Z: 撤销
 Ctrl+Y: 重做
 Ctrl+F: 查找
+F3 / Shift+F3: 查找下一个 / 上一个
+Esc: 清除查找高亮
 Ctrl+H: 替换
 Ctrl+B: 新建缓冲区
 Ctrl+Tab: 切换缓冲区
@@ -405,8 +630,8 @@ F1: 帮助"""
 平台: {platform.platform()}
 Python版本: {platform.python_version()}
 
-当前缓冲区: {self.current_buffer}
-缓冲区数量: {len(self.buffers)}"""
+当前缓冲区: {self.session.current}
+缓冲区数量: {len(self.session.buffers)}"""
         messagebox.showinfo("调试信息", debug_text)
 
 if __name__ == "__main__":
@@ -1,16 +1,93 @@
-from PyQt5.QtWidgets import (QApplication, QMainWindow, QTextEdit, QAction, 
+from PyQt5.QtWidgets import (QApplication, QMainWindow, QTextEdit, QPlainTextEdit, QAction, 
                             QFileDialog, QMessageBox, QInputDialog, QToolBar,
-                            QStatusBar, QVBoxLayout, QWidget, QLabel, QSplitter, QStyle)
-from PyQt5.QtGui import QIcon, QTextCursor, QTextCharFormat, QColor
-from PyQt5.QtCore import Qt, QSize
+                            QStatusBar, QVBoxLayout, QWidget, QLabel, QSplitter, QStyle,
+                            QProgressBar, QPushButton, QPlainTextDocumentLayout)
+from PyQt5.QtGui import QIcon, QTextCursor, QTextCharFormat, QColor, QTextDocument
+from PyQt5.QtCore import Qt, QSize, QThread, QTimer, QPoint, pyqtSignal
+from bisect import bisect_left, bisect_right
+import os
 import platform
 import re
 import sys
+from nightnote_core import (Session, TextFile, get_matcher, lines_to_text, mark_loaded,
+                            restore_session, save_session, text_edits, text_format, utf8_size)
 
 MAINNAME = "NightNote"
 VERSION = "250814"
 AUTHOR = "DONGFANG Lingye"
 EMAIL = "ly@lingye.online"
+# 后台加载时每块读取、解码的字节数，块越小界面越流畅
+LOAD_CHUNK_BYTES = 256 * 1024
+# 退出时保存、启动时恢复的会话文件
+SESSION_FILE = os.path.join(os.path.expanduser("~"), ".nightnote_pyqt.session")
+
+class FileLoader(QThread):
+    # 后台线程：按块读取、解码并切分文件，逐块把行交给界面线程显示
+    chunk_loaded = pyqtSignal(object, int)  # (行列表, 已读字节数)
+    load_failed = pyqtSignal(str)
+    
+    def __init__(self, filename, encoding=None, parent=None):
+        super().__init__(parent)
+        self.filename = filename
+        self.encoding = encoding  # None 表示从文件开头探测，读完后是实际采用的编码
+        self.newline = None
+        self.total = 0
+        self.stat = None
+    
+    def run(self):
+        try:
+            with TextFile(self.filename, self.encoding, size=LOAD_CHUNK_BYTES) as f:
+                self.stat = f.stat
+                self.total = f.stat.st_size
+                self.encoding = f.encoding
+                for lines in f:
+                    if self.isInterruptionRequested():
+                        return
+                    self.chunk_loaded.emit(lines, f.tell())
+                self.newline = f.newline
+        except Exception as e:
+            self.load_failed.emit(str(e))
+
+class SaveWorker(QThread):
+    # 后台线程：把保存快照编码写入临时文件，fsync 后改名覆盖，收尾交给界面线程
+    def __init__(self, job, parent=None):
+        super().__init__(parent)
+        self.job = job
+    
+    def run(self):
+        self.job.run()  # 出错时记在 job.error 里，由 finish_save 重新抛出
+
+# 文档达到这个大小（字节）时改用 QPlainTextEdit，只布局可见的块
+LARGE_DOCUMENT_BYTES = 2 * 1024 * 1024
+# 一次编辑涉及的行数超过此值时改为后台重新查找，而不是在界面线程里逐行重算
+HIGHLIGHT_INLINE_BLOCKS = 200
+# 编辑或滚动后延迟多久（毫秒）再重新查找 / 重绘高亮
+HIGHLIGHT_RESCAN_MS = 300
+HIGHLIGHT_PAINT_MS = 15
+# 编辑、移动光标后延迟多久（毫秒）刷新状态栏
+STATUS_UPDATE_MS = 100
+
+class MatchWorker(QThread):
+    # 后台线程：在缓冲区快照里找出所有匹配，给出有匹配的行号及各行的匹配区间
+    matches_found = pyqtSignal(object, object)  # (行号列表, 区间列表)
+    
+    def __init__(self, matcher, chunks, parent=None):
+        super().__init__(parent)
+        self.matcher = matcher
+        self.chunks = chunks
+    
+    def run(self):
+        blocks = []
+        spans = []
+        idx = 0
+        for chunk in self.chunks:
+            if self.isInterruptionRequested():
+                return
+            for i, line in self.matcher.grep([chunk], idx):
+                blocks.append(i)
+                spans.append(list(self.matcher.finditer(line)))
+            idx += len(chunk)
+        self.matches_found.emit(blocks, spans)
 
 class NightNoteGUI(QMainWindow):
     def __init__(self):
@@ -19,16 +96,29 @@ class NightNoteGUI(QMainWindow):
         self.__version__ = VERSION
         self.__author__ = AUTHOR
         self.__email__ = EMAIL
-        # 缓冲区
-        self.buffers = [""]
-        self.buffer_files = [""]
-        self.current_buffer = 0
-        # 历史记录
-        self.history = []
-        self.redo_history = []
-        self.MAX_HISTORY = 10
+        # 缓冲区和历史记录都交给编辑核心；每个缓冲区有自己的 QTextDocument，
+        # 切换缓冲区只是把文档换进编辑框
+        self.session = Session()
+        self.documents = []
+        self.view_states = {}  # 文档 -> (光标, 垂直滚动, 水平滚动)
+        # 状态栏用的字节数：文档 -> 每行字节数（含换行符）及其总和，随 contentsChange 增量维护
+        self.block_bytes = {}
+        self.document_bytes = {}
+        self.loading_document = None
+        self.unfilled_documents = set()  # 恢复会话后还没显示过、内容尚未填入的文档
+        # 后台加载状态
+        self.loader = None
+        self.saver = None
+        self.loading_lines = []
+        self.load_error = None
+        # 全部高亮：按行号排序的有匹配的行，以及每行的匹配区间
+        self.highlight_matcher = None
+        self.match_blocks = []
+        self.match_spans = []
+        self.match_worker = None
         
         self.initUI()
+        self.restore_last_session()
         self.update_title()
         self.update_status()
     
@@ -57,20 +147,28 @@ class NightNoteGUI(QMainWindow):
         central_widget = QWidget()
         self.setCentralWidget(central_widget)
         # 主布局
-        main_layout = QVBoxLayout(central_widget)
-        main_layout.setContentsMargins(0, 0, 0, 0)
+        self.main_layout = QVBoxLayout(central_widget)
+        self.main_layout.setContentsMargins(0, 0, 0, 0)
+        # 高亮只画可见的行：滚动、缩放后合并成一次重绘
+        self.highlight_format = QTextCharFormat()
+        self.highlight_format.setBackground(QColor("yellow"))
+        self.highlight_format.setForeground(QColor("black"))
+        self.paint_timer = QTimer(self)
+        self.paint_timer.setSingleShot(True)
+        self.paint_timer.setInterval(HIGHLIGHT_PAINT_MS)
+        self.paint_timer.timeout.connect(self.paint_visible_matches)
+        self.rescan_timer = QTimer(self)
+        self.rescan_timer.setSingleShot(True)
+        self.rescan_timer.setInterval(HIGHLIGHT_RESCAN_MS)
+        self.rescan_timer.timeout.connect(self.start_highlight)
+        self.status_timer = QTimer(self)
+        self.status_timer.setSingleShot(True)
+        self.status_timer.setInterval(STATUS_UPDATE_MS)
+        self.status_timer.timeout.connect(self.update_status)
         # 文本编辑区域
-        self.text_edit = QTextEdit()
-        self.text_edit.setStyleSheet(f"""
-            QTextEdit {{
-                font-family: Consolas;
-                font-size: 12pt;
-                background-color: {self.bg_color};
-                color: {self.text_color};
-            }}
-        """)
-        # 添加到布局
-        main_layout.addWidget(self.text_edit)
+        self.text_edit = None
+        self.documents.append(self.new_document(False))
+        self.attach_document(0)
         # 菜单栏
         self.create_menubar()
         # 工具栏
@@ -94,6 +192,127 @@ class NightNoteGUI(QMainWindow):
         self.buffer_label = QLabel()
         self.status_bar.addPermanentWidget(self.status_label, 1)
         self.status_bar.addPermanentWidget(self.buffer_label)
+        
+        # 加载进度和取消按钮，只在后台加载时显示
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setRange(0, 100)
+        self.progress_bar.setMaximumWidth(200)
+        self.cancel_button = QPushButton("取消")
+        self.cancel_button.clicked.connect(self.cancel_load)
+        self.status_bar.addPermanentWidget(self.progress_bar)
+        self.status_bar.addPermanentWidget(self.cancel_button)
+        self.progress_bar.hide()
+        self.cancel_button.hide()
+    
+    def new_document(self, large):
+        # 大文档用 QPlainTextDocumentLayout，只能放进 QPlainTextEdit
+        document = QTextDocument(self)
+        if large:
+            document.setDocumentLayout(QPlainTextDocumentLayout(document))
+        document.contentsChange.connect(self.on_contents_change)
+        self.block_bytes[document] = [1]  # 空文档也有一个块
+        self.document_bytes[document] = 1
+        return document
+    
+    def drop_document(self, document):
+        for states in (self.view_states, self.block_bytes, self.document_bytes):
+            states.pop(document, None)
+        self.unfilled_documents.discard(document)
+        document.deleteLater()
+    
+    def restore_last_session(self):
+        # 恢复上次退出时的会话；文档先建成空的，第一次显示时才填入内容
+        if not os.path.exists(SESSION_FILE):
+            return
+        try:
+            stale = restore_session(self.session, SESSION_FILE)
+        except (OSError, ValueError) as e:
+            QMessageBox.warning(self, "会话", f"无法恢复会话: {str(e)}")
+            return
+        old = self.documents
+        self.documents = [self.new_document(buf.byte_count >= LARGE_DOCUMENT_BYTES)
+                          for buf in self.session.buffers]
+        self.unfilled_documents = set(self.documents)
+        self.attach_document(self.session.current)
+        for document in old:
+            self.drop_document(document)
+        if stale:
+            QMessageBox.information(self, "会话", "以下文件在磁盘上已改变，对应的缓冲区没有恢复:\n" + "\n".join(stale))
+    
+    def save_current_session(self):
+        self.sync_all()
+        try:
+            save_session(self.session, SESSION_FILE)
+        except Exception as e:
+            QMessageBox.critical(self, "错误", f"无法保存会话: {str(e)}")
+    
+    def is_large(self, document):
+        return isinstance(document.documentLayout(), QPlainTextDocumentLayout)
+    
+    def attach_document(self, idx):
+        # 把缓冲区 idx 的文档换进编辑框并恢复它自己的光标和滚动位置，不重新解析文本
+        document = self.documents[idx]
+        if document in self.unfilled_documents:
+            self.unfilled_documents.discard(document)
+            document.setPlainText(lines_to_text(self.session.buffers[idx]))
+            document.setModified(False)
+        if self.text_edit is not None:
+            current = self.text_edit.document()
+            if current is document:
+                return
+            if current in self.documents:
+                self.view_states[current] = (self.text_edit.textCursor(),
+                                             self.text_edit.verticalScrollBar().value(),
+                                             self.text_edit.horizontalScrollBar().value())
+        self.set_editor(self.is_large(document))
+        self.text_edit.setDocument(document)
+        state = self.view_states.get(document)
+        if state is not None:
+            cursor, vertical, horizontal = state
+            self.text_edit.setTextCursor(cursor)
+            self.text_edit.verticalScrollBar().setValue(vertical)
+            self.text_edit.horizontalScrollBar().setValue(horizontal)
+        # 高亮缓存属于原来的文档
+        self.match_blocks = []
+        self.match_spans = []
+        self.text_edit.setExtraSelections([])
+        if self.highlight_matcher is not None:
+            self.rescan_timer.start()
+    
+    def replace_document(self, idx, large):
+        # 换一个新的（可能是另一种布局的）空文档给缓冲区 idx
+        old = self.documents[idx]
+        self.documents[idx] = self.new_document(large)
+        if self.text_edit.document() is old:
+            self.attach_document(idx)
+        self.drop_document(old)
+        return self.documents[idx]
+    
+    def set_editor(self, large):
+        # 大文档用 QPlainTextEdit（按块虚拟化布局、不换行），小文档仍用 QTextEdit
+        cls = QPlainTextEdit if large else QTextEdit
+        if isinstance(self.text_edit, cls):
+            return
+        editor = cls()
+        editor.setStyleSheet(f"""
+            {cls.__name__} {{
+                font-family: Consolas;
+                font-size: 12pt;
+                background-color: {self.bg_color};
+                color: {self.text_color};
+            }}
+        """)
+        if large:
+            editor.setLineWrapMode(QPlainTextEdit.NoWrap)
+        editor.verticalScrollBar().valueChanged.connect(self.paint_timer.start)
+        editor.cursorPositionChanged.connect(self.status_timer.start)
+        if self.text_edit is None:
+            self.main_layout.addWidget(editor)
+        else:
+            self.main_layout.replaceWidget(self.text_edit, editor)
+            self.text_edit.deleteLater()
+        self.text_edit = editor
+        editor.setFocus()
     
     def create_menubar(self):
         menubar = self.menuBar()
@@ -146,6 +365,21 @@ class NightNoteGUI(QMainWindow):
         find_action.triggered.connect(self.search_text)
         edit_menu.addAction(find_action)
         
+        find_next_action = QAction('查找下一个', self)
+        find_next_action.setShortcut('F3')
+        find_next_action.triggered.connect(self.find_next)
+        edit_menu.addAction(find_next_action)
+        
+        find_prev_action = QAction('查找上一个', self)
+        find_prev_action.setShortcut('Shift+F3')
+        find_prev_action.triggered.connect(self.find_previous)
+        edit_menu.addAction(find_prev_action)
+        
+        clear_highlight_action = QAction('清除高亮', self)
+        clear_highlight_action.setShortcut('Escape')
+        clear_highlight_action.triggered.connect(self.clear_highlight)
+        edit_menu.addAction(clear_highlight_action)
+        
         replace_action = QAction('替换', self)
         replace_action.setShortcut('Ctrl+H')
         replace_action.triggered.connect(self.replace_text)
@@ -243,143 +477,399 @@ class NightNoteGUI(QMainWindow):
             toolbar.addAction(action)
     
     def update_title(self):
-        filename = self.buffer_files[self.current_buffer]
+        filename = self.session.filename
         title = f"{self.__mainname__} {self.__version__}"
         if filename:
             title += f" - {filename}"
         self.setWindowTitle(title)
     
     def update_status(self):
-        text = self.buffers[self.current_buffer]
-        lines = len(text.split('\n')) if text else 0
-        size = len(text.encode('utf-8')) if text else 0
-        self.status_label.setText(f"{lines} lines | {size} bytes")
-        self.buffer_label.setText(f"Buffer: {self.current_buffer+1}/{len(self.buffers)}")
-    
-    def save_state(self, operation):
-        # 保存当前状态到历史记录
-        if len(self.history) >= self.MAX_HISTORY:
-            self.history.pop(0)
-        self.history.append((self.current_buffer, self.buffers[self.current_buffer], 
-                          self.buffer_files[self.current_buffer]))
-        self.redo_history.clear()
+        # 行数取文档块数，字节数是增量维护的结果，刷新与文档大小无关
+        self.status_timer.stop()
+        document = self.text_edit.document()
+        if document.isEmpty():
+            lines, size = 0, 0
+        else:
+            lines, size = document.blockCount(), self.document_bytes[document]
+        cursor = self.text_edit.textCursor()
+        position = f"Ln {cursor.blockNumber()+1}, Col {cursor.positionInBlock()+1}"
+        mode = " | plain text mode" if isinstance(self.text_edit, QPlainTextEdit) else ""
+        self.status_label.setText(f"{lines} lines | {size} bytes | {position}{mode}")
+        self.buffer_label.setText(f"Buffer: {self.session.current+1}/{len(self.session.buffers)}")
     
-    def new_file(self):
-        self.save_state("新建文件")
-        self.buffers[self.current_buffer] = ""
-        self.buffer_files[self.current_buffer] = ""
-        self.text_edit.clear()
+    def sync_buffer(self, idx=None):
+        # 文档改动过时把变化的行同步进编辑核心对应的缓冲区，作为一条可撤销的历史
+        if idx is None:
+            idx = self.session.current
+        document = self.documents[idx]
+        if self.loader is None and document.isModified():
+            current = self.session.current
+            self.session.current = idx  # 编辑核心按当前缓冲区记录历史
+            try:
+                self.session.sync(document.toPlainText(), "编辑")
+            finally:
+                self.session.current = current
+            document.setModified(False)
+    
+    def apply_last_edit(self):
+        # 只把编辑核心最近一次修改涉及的文本改到对应缓冲区的文档上，其余的块和滚动位置不动；
+        # 不用 beginEditBlock，否则分散的修改会合并成一次覆盖全文的 contentsChange
+        buf_idx, changes = self.session.last_edit
+        document = self.documents[buf_idx]
+        if document in self.unfilled_documents:
+            changes = []  # 还没填入内容，显示时直接取编辑核心里修改后的内容
+        document.setUndoRedoEnabled(False)
+        cursor = QTextCursor(document)
+        for line1, col1, line2, col2, text in text_edits(changes, len(self.session.buffers[buf_idx])):
+            cursor.setPosition(self.text_position(document, line1, col1))
+            cursor.setPosition(self.text_position(document, line2, col2), QTextCursor.KeepAnchor)
+            cursor.insertText(text)
+        document.setUndoRedoEnabled(True)
+        document.setModified(False)
+        self.attach_document(buf_idx)
+        self.update_title()
+        self.update_status()
+    
+    def text_position(self, document, line, column):
+        # 列为 None 表示行尾
+        block = document.findBlockByNumber(line)
+        return block.position() + (block.length() - 1 if column is None else column)
+    
+    def sync_all(self):
+        # 撤销/重做可能落到其他缓冲区，先把所有改动过的文档同步
+        for idx in range(len(self.documents)):
+            self.sync_buffer(idx)
+    
+    def show_buffer(self):
+        # 用编辑核心里的内容重建当前缓冲区的文档，按大小选择文档布局
+        idx = self.session.current
+        large = self.session.buffer.byte_count >= LARGE_DOCUMENT_BYTES
+        document = self.documents[idx]
+        if self.is_large(document) != large:
+            document = self.replace_document(idx, large)
+        self.unfilled_documents.discard(document)
+        self.attach_document(idx)
+        document.setPlainText(lines_to_text(self.session.buffer))
+        document.setModified(False)
         self.update_title()
         self.update_status()
     
+    def new_file(self):
+        self.sync_buffer()
+        self.session.edit("新建文件", 0, len(self.session.buffer), [], filename="")
+        self.show_buffer()
+    
     def open_file(self):
         filename, _ = QFileDialog.getOpenFileName(self, "打开文件")
         if filename:
+            # 读取和解码在后台线程进行，编辑框随每块到达逐步填充
+            self.sync_buffer()
             try:
-                with open(filename, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                self.save_state(f"打开文件 {filename}")
-                self.buffers[self.current_buffer] = content
-                self.buffer_files[self.current_buffer] = filename
-                self.text_edit.setPlainText(content)
-                self.update_title()
-                self.update_status()
-            except Exception as e:
-                QMessageBox.critical(self, "错误", f"无法打开文件: {str(e)}")
+                size = os.path.getsize(filename)
+            except OSError:
+                size = 0  # 错误由后台线程报告
+            # 加载到一个新文档里，取消或失败时再按编辑核心的内容重建
+            self.loading_document = self.replace_document(self.session.current, size >= LARGE_DOCUMENT_BYTES)
+            self.loading_lines = []
+            self.load_error = None
+            self.set_loading(True)
+            self.loader = FileLoader(filename, parent=self)
+            self.loader.chunk_loaded.connect(self.on_chunk_loaded)
+            self.loader.load_failed.connect(self.on_load_failed)
+            self.loader.finished.connect(self.on_load_finished)
+            self.status_label.setText(f"正在加载 {filename}")
+            self.loader.start()
     
-    def save_file(self):
-        if not self.buffer_files[self.current_buffer]:
-            self.save_as()
+    def set_loading(self, loading):
+        # 加载期间编辑框只读、关闭撤销记录，并禁用其他操作
+        self.text_edit.setReadOnly(loading)
+        self.text_edit.document().setUndoRedoEnabled(not loading)
+        for action in self.findChildren(QAction):
+            action.setEnabled(not loading)
+        self.progress_bar.setValue(0)
+        self.progress_bar.setVisible(loading)
+        self.cancel_button.setVisible(loading)
+    
+    def on_chunk_loaded(self, lines, done):
+        if self.loader is None or self.loader.isInterruptionRequested():
             return
-        
-        try:
-            content = self.text_edit.toPlainText()
-            with open(self.buffer_files[self.current_buffer], 'w', encoding='utf-8') as f:
-                f.write(content)
-            self.save_state(f"保存文件 {self.buffer_files[self.current_buffer]}")
-            self.buffers[self.current_buffer] = content
-            self.status_label.setText("文件保存成功")
+        text = "\n".join(lines)
+        if self.loading_lines:
+            text = "\n" + text
+        cursor = QTextCursor(self.loading_document)
+        cursor.movePosition(QTextCursor.End)
+        cursor.insertText(text)
+        self.loading_lines.extend(lines)
+        self.progress_bar.setValue(min(100, done * 100 // max(self.loader.total, 1)))
+    
+    def on_load_failed(self, message):
+        self.load_error = message
+    
+    def on_load_finished(self):
+        loader, self.loader = self.loader, None
+        lines, self.loading_lines = self.loading_lines, []
+        document, self.loading_document = self.loading_document, None
+        self.set_loading(False)
+        if self.load_error is None and not loader.isInterruptionRequested():
+            # 编辑框里已经是完整内容，只需把行交给编辑核心
+            self.session.edit(f"打开文件 {loader.filename}", 0, len(self.session.buffer), lines,
+                              filename=loader.filename)
+            mark_loaded(self.session.buffer, loader.filename, loader.encoding, loader.stat, loader.newline)
+            document.setModified(False)
+            self.update_title()
             self.update_status()
+            if self.highlight_matcher is not None:
+                self.start_highlight()
+            return
+        self.show_buffer()
+        if self.load_error is not None:
+            QMessageBox.critical(self, "错误", f"无法打开文件: {self.load_error}")
+        else:
+            self.status_label.setText("已取消加载")
+    
+    def cancel_load(self):
+        if self.loader is not None:
+            self.loader.requestInterruption()
+    
+    def closeEvent(self, event):
+        if self.loader is not None:
+            self.loader.requestInterruption()
+            self.loader.wait()
+        if self.saver is not None:
+            self.saver.wait()  # 让正在写的文件完整落盘
+            self.on_save_finished()  # 收尾之后缓冲区才知道自己已经改存为新文件
+        self.save_current_session()
+        super().closeEvent(event)
+    
+    def write_buffer(self, filename, operation):
+        # 界面线程只同步并给缓冲区拍快照，编码和写盘在后台线程里做，完成后再报告
+        if self.saver is not None:
+            QMessageBox.information(self, "保存", "上一次保存尚未完成")
+            return
+        self.sync_buffer()
+        # 沿用文件原来的编码和换行符，新建的文件用 UTF-8
+        encoding, _ = text_format(self.session.buffer)
+        job = self.session.start_save(operation, filename, encoding=encoding or 'utf-8')
+        self.saver = SaveWorker(job, parent=self)
+        self.saver.finished.connect(self.on_save_finished)
+        self.status_label.setText("正在保存...")
+        self.saver.start()
+    
+    def on_save_finished(self):
+        if self.saver is None:
+            return  # 关闭窗口时已经收尾
+        saver, self.saver = self.saver, None
+        saver.deleteLater()
+        try:
+            self.session.finish_save(saver.job)
         except Exception as e:
             QMessageBox.critical(self, "错误", f"无法保存文件: {str(e)}")
+            return
+        self.update_title()
+        self.update_status()
+        self.status_label.setText("文件保存成功")
+    
+    def save_file(self):
+        if not self.session.filename:
+            self.save_as()
+            return
+        
+        self.write_buffer(self.session.filename, f"保存文件 {self.session.filename}")
     
     def save_as(self):
         filename, _ = QFileDialog.getSaveFileName(self, "另存为")
         if filename:
-            try:
-                content = self.text_edit.toPlainText()
-                with open(filename, 'w', encoding='utf-8') as f:
-                    f.write(content)
-                self.save_state(f"另存为 {filename}")
-                self.buffers[self.current_buffer] = content
-                self.buffer_files[self.current_buffer] = filename
-                self.update_title()
-                self.update_status()
-                self.status_label.setText("文件保存成功")
-            except Exception as e:
-                QMessageBox.critical(self, "错误", f"无法保存文件: {str(e)}")
+            self.write_buffer(filename, f"另存为 {filename}")
     
     def undo_last(self):
-        if not self.history:
+        self.sync_all()
+        delta = self.session.undo()
+        if delta is None:
             QMessageBox.information(self, "撤销", "没有可撤销的操作")
             return
         
-        buf_idx, buf_content, buf_file = self.history.pop()
-        self.redo_history.append((self.current_buffer, self.buffers[self.current_buffer], 
-                                self.buffer_files[self.current_buffer]))
-        self.current_buffer = buf_idx
-        self.buffers[buf_idx] = buf_content
-        self.buffer_files[buf_idx] = buf_file
-        self.text_edit.setPlainText(buf_content)
-        self.update_title()
-        self.update_status()
-        QMessageBox.information(self, "撤销", f"已撤销操作，恢复缓冲区 {buf_idx}")
+        self.apply_last_edit()
+        QMessageBox.information(self, "撤销", f"已撤销操作，恢复缓冲区 {delta.buf_idx}")
     
     def redo(self):
-        if not self.redo_history:
+        self.sync_all()
+        delta = self.session.redo()
+        if delta is None:
             QMessageBox.information(self, "重做", "没有可重做的操作")
             return
         
-        buf_idx, buf_content, buf_file = self.redo_history.pop()
-        self.history.append((self.current_buffer, self.buffers[self.current_buffer], 
-                           self.buffer_files[self.current_buffer]))
-        self.current_buffer = buf_idx
-        self.buffers[buf_idx] = buf_content
-        self.buffer_files[buf_idx] = buf_file
-        self.text_edit.setPlainText(buf_content)
-        self.update_title()
-        self.update_status()
-        QMessageBox.information(self, "重做", f"已重做操作，恢复缓冲区 {buf_idx}")
+        self.apply_last_edit()
+        QMessageBox.information(self, "重做", f"已重做操作，恢复缓冲区 {delta.buf_idx}")
     
     def search_text(self):
         pattern, ok = QInputDialog.getText(self, "查找", "输入要查找的内容:")
         if ok and pattern:
-            content = self.text_edit.toPlainText()
             try:
-                regex = re.compile(pattern)
-                matches = [m for m in regex.finditer(content)]
-                
-                if not matches:
-                    QMessageBox.information(self, "查找", "未找到匹配内容")
-                else:
-                    # 高亮显示第一个匹配项
-                    first_match = matches[0]
-                    cursor = self.text_edit.textCursor()
-                    cursor.setPosition(first_match.start())
-                    cursor.movePosition(QTextCursor.Right, QTextCursor.KeepAnchor, 
-                                      first_match.end() - first_match.start())
-                    
-                    # 设置高亮格式
-                    fmt = QTextCharFormat()
-                    fmt.setBackground(QColor("yellow"))
-                    cursor.mergeCharFormat(fmt)
-                    
-                    self.text_edit.setTextCursor(cursor)
-                    self.text_edit.setFocus()
-                    
-                    QMessageBox.information(self, "查找", f"找到 {len(matches)} 处匹配")
+                self.highlight_matcher = get_matcher(pattern)
             except re.error:
                 QMessageBox.critical(self, "错误", "无效的正则表达式")
+                return
+            # 在后台找出全部匹配并高亮，结果到达后跳到光标之后的第一个
+            self.start_highlight(jump=True)
+    
+    def start_highlight(self, jump=False):
+        if self.highlight_matcher is None or self.loader is not None:
+            return
+        if self.match_worker is not None:
+            self.match_worker.requestInterruption()
+        self.rescan_timer.stop()
+        self.sync_buffer()
+        # 绳索按块切片得到的是独立列表，后台线程读这份快照不受后续编辑影响
+        chunks = list(self.session.buffer.iter_chunks())
+        worker = MatchWorker(self.highlight_matcher, chunks, parent=self)
+        worker.matches_found.connect(lambda blocks, spans: self.on_matches_found(worker, blocks, spans, jump))
+        worker.finished.connect(worker.deleteLater)
+        self.match_worker = worker
+        self.status_label.setText("正在查找...")
+        worker.start()
+    
+    def on_matches_found(self, worker, blocks, spans, jump):
+        if worker is not self.match_worker:
+            return  # 已被更新的查找取代
+        self.match_worker = None
+        self.match_blocks = blocks
+        self.match_spans = spans
+        count = sum(len(line_spans) for line_spans in spans)
+        if count == 0:
+            self.status_label.setText("未找到匹配内容")
+        else:
+            self.status_label.setText(f"找到 {count} 处匹配")
+            if jump:
+                self.find_next()
+        self.paint_visible_matches()
+    
+    def clear_highlight(self):
+        if self.match_worker is not None:
+            self.match_worker.requestInterruption()
+            self.match_worker = None
+        self.rescan_timer.stop()
+        self.highlight_matcher = None
+        self.match_blocks = []
+        self.match_spans = []
+        self.text_edit.setExtraSelections([])
+    
+    def on_contents_change(self, position, removed, added):
+        # 只重算被编辑的行的字节数；编辑框里的文档再平移高亮并安排刷新状态栏
+        document = self.sender()
+        line_bytes = self.block_bytes[document]
+        delta = document.blockCount() - len(line_bytes)
+        end = min(position + added, document.characterCount() - 1)
+        first_block = document.findBlock(position)
+        last_block = document.findBlock(end)
+        first = first_block.blockNumber()
+        last = last_block.blockNumber()
+        # 改动前这些行是 [first, last - delta]，选区文本里的段落分隔符是 U+2029
+        cursor = QTextCursor(document)
+        cursor.setPosition(first_block.position())
+        cursor.setPosition(last_block.position() + last_block.length() - 1, QTextCursor.KeepAnchor)
+        new_bytes = [utf8_size(line) + 1
+                     for line in cursor.selectedText().split("\u2029")]
+        stop = last - delta + 1
+        self.document_bytes[document] += sum(new_bytes) - sum(line_bytes[first:stop])
+        line_bytes[first:stop] = new_bytes
+        if document is self.text_edit.document():
+            self.status_timer.start()
+            self.shift_matches(document, first, last, delta)
+    
+    def shift_matches(self, document, first, last, delta):
+        # 只重算被编辑的行，其后的行号整体平移；大范围改动交给后台重新查找
+        if self.highlight_matcher is None:
+            return
+        if self.match_worker is not None:
+            self.rescan_timer.start()
+            return
+        if last - first > HIGHLIGHT_INLINE_BLOCKS:
+            self.rescan_timer.start()
+            return
+        new_blocks = []
+        new_spans = []
+        block = document.findBlockByNumber(first)
+        for number in range(first, last + 1):
+            spans = list(self.highlight_matcher.finditer(block.text()))
+            if spans:
+                new_blocks.append(number)
+                new_spans.append(spans)
+            block = block.next()
+        lo = bisect_left(self.match_blocks, first)
+        hi = bisect_right(self.match_blocks, last - delta)
+        tail = self.match_blocks[hi:]
+        if delta:
+            tail = [number + delta for number in tail]
+        self.match_blocks[lo:] = new_blocks + tail
+        self.match_spans[lo:hi] = new_spans
+        self.paint_timer.start()
+    
+    def paint_visible_matches(self):
+        if self.highlight_matcher is None:
+            self.text_edit.setExtraSelections([])
+            return
+        viewport = self.text_edit.viewport()
+        first = self.text_edit.cursorForPosition(QPoint(0, 0)).blockNumber()
+        last = self.text_edit.cursorForPosition(QPoint(viewport.width() - 1, viewport.height() - 1)).blockNumber()
+        document = self.text_edit.document()
+        selections = []
+        for k in range(bisect_left(self.match_blocks, first), bisect_right(self.match_blocks, last)):
+            position = document.findBlockByNumber(self.match_blocks[k]).position()
+            for start, end in self.match_spans[k]:
+                selection = QTextEdit.ExtraSelection()
+                selection.format = self.highlight_format
+                selection.cursor = QTextCursor(document)
+                selection.cursor.setPosition(position + start)
+                selection.cursor.setPosition(position + end, QTextCursor.KeepAnchor)
+                selections.append(selection)
+        self.text_edit.setExtraSelections(selections)
+    
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.paint_timer.start()
+    
+    def select_match(self, k, span):
+        position = self.text_edit.document().findBlockByNumber(self.match_blocks[k]).position()
+        cursor = self.text_edit.textCursor()
+        cursor.setPosition(position + span[0])
+        cursor.setPosition(position + span[1], QTextCursor.KeepAnchor)
+        self.text_edit.setTextCursor(cursor)
+        self.text_edit.setFocus()
+    
+    def find_next(self):
+        # 在缓存的匹配里找光标之后的第一个，到末尾后从头开始
+        if not self.match_blocks:
+            self.status_label.setText("未找到匹配内容" if self.highlight_matcher else "请先查找")
+            return
+        cursor = self.text_edit.textCursor()
+        block = cursor.block()
+        line, column = block.blockNumber(), cursor.selectionEnd() - block.position()
+        k = bisect_left(self.match_blocks, line)
+        if k < len(self.match_blocks) and self.match_blocks[k] == line:
+            for span in self.match_spans[k]:
+                if span[0] >= column and span[1] > span[0]:
+                    self.select_match(k, span)
+                    return
+            k += 1
+        k %= len(self.match_blocks)
+        self.select_match(k, self.match_spans[k][0])
+    
+    def find_previous(self):
+        if not self.match_blocks:
+            self.status_label.setText("未找到匹配内容" if self.highlight_matcher else "请先查找")
+            return
+        cursor = self.text_edit.textCursor()
+        position = cursor.selectionStart()
+        block = self.text_edit.document().findBlock(position)
+        line, column = block.blockNumber(), position - block.position()
+        k = bisect_right(self.match_blocks, line) - 1
+        if k >= 0 and self.match_blocks[k] == line:
+            for span in reversed(self.match_spans[k]):
+                if span[1] <= column and span[1] > span[0]:
+                    self.select_match(k, span)
+                    return
+            k -= 1
+        self.select_match(k, self.match_spans[k][-1])
     
     def replace_text(self):
         pattern, ok = QInputDialog.getText(self, "替换", "输入要查找的内容:")
@@ -390,21 +880,12 @@ class NightNoteGUI(QMainWindow):
         if not ok:
             return
             
-        content = self.text_edit.toPlainText()
+        self.sync_buffer()
         try:
-            regex = re.compile(pattern)
-            new_content, count = regex.subn(replacement, content)
+            count = self.session.replace_all(f"替换 '{pattern}' 为 '{replacement}'", get_matcher(pattern), replacement)
             
             if count > 0:
-                self.save_state(f"替换 '{pattern}' 为 '{replacement}'")
-                self.buffers[self.current_buffer] = new_content
-                self.text_edit.setPlainText(new_content)
-                # 清除所有高亮
-                cursor = self.text_edit.textCursor()
-                cursor.select(QTextCursor.Document)
-                fmt = QTextCharFormat()
-                fmt.setBackground(QColor(Qt.transparent))
-                cursor.mergeCharFormat(fmt)
+                self.apply_last_edit()
                 self.status_label.setText(f"替换了 {count} 处")
             else:
                 self.status_label.setText("未找到匹配内容")
@@ -412,55 +893,47 @@ class NightNoteGUI(QMainWindow):
             QMessageBox.critical(self, "错误", "无效的正则表达式")
     
     def new_buffer(self):
-        self.save_state("新建缓冲区")
-        self.buffers.append("")
-        self.buffer_files.append("")
-        self.current_buffer = len(self.buffers) - 1
-        self.text_edit.clear()
+        self.session.new_buffer()
+        self.documents.append(self.new_document(False))
+        self.attach_document(self.session.current)
         self.update_title()
         self.update_status()
-        QMessageBox.information(self, "缓冲区", f"已创建新缓冲区 {self.current_buffer}")
+        QMessageBox.information(self, "缓冲区", f"已创建新缓冲区 {self.session.current}")
     
     def switch_buffer(self):
         buf_num, ok = QInputDialog.getInt(self, "切换缓冲区", 
                                         "输入缓冲区编号:", 
-                                        min=0, max=len(self.buffers)-1)
+                                        min=0, max=len(self.session.buffers)-1)
         if ok:
-            self.save_state(f"切换到缓冲区 {buf_num}")
-            self.current_buffer = buf_num
-            self.text_edit.setPlainText(self.buffers[buf_num])
+            # 未同步的改动留在各自的文档里，切换不需要同步也不需要重新解析
+            self.session.switch(buf_num)
+            self.attach_document(buf_num)
             self.update_title()
             self.update_status()
     
     def remove_buffer(self):
-        if len(self.buffers) == 1:
+        if len(self.session.buffers) == 1:
             QMessageBox.critical(self, "错误", "必须保留至少一个缓冲区")
             return
             
         buf_num, ok = QInputDialog.getInt(self, "删除缓冲区", 
                                          "输入要删除的缓冲区编号:", 
-                                         min=0, max=len(self.buffers)-1)
+                                         min=0, max=len(self.session.buffers)-1)
         if ok:
-            self.save_state(f"删除缓冲区 {buf_num}")
-            self.buffers.pop(buf_num)
-            self.buffer_files.pop(buf_num)
-            
-            if self.current_buffer == buf_num:
-                self.current_buffer = 0
-            elif self.current_buffer > buf_num:
-                self.current_buffer -= 1
-                
-            self.text_edit.setPlainText(self.buffers[self.current_buffer])
+            self.session.remove(buf_num)
+            document = self.documents.pop(buf_num)
+            self.attach_document(self.session.current)
+            self.drop_document(document)
             self.update_title()
             self.update_status()
             QMessageBox.information(self, "删除", f"已删除缓冲区 {buf_num}")
     
     def list_buffers(self):
+        self.sync_all()
         info = "缓冲区列表:\n"
-        for idx, (buf, fname) in enumerate(zip(self.buffers, self.buffer_files)):
-            size = len(buf.encode('utf-8'))
-            lines = len(buf.split('\n'))
-            mark = " <-- 当前" if idx == self.current_buffer else ""
+        for idx, (buf, fname) in enumerate(zip(self.session.buffers, self.session.buffer_files)):
+            lines, size, _ = buf.stats()
+            mark = " <-- 当前" if idx == self.session.current else ""
             info += f"[{idx}] {lines} 行, {size} 字节, '{fname}'{mark}\n"
         QMessageBox.information(self, "缓冲区列表", info)
     
@@ -482,6 +955,8 @@ Ctrl+Z: 撤销
 Ctrl+Y: 重做
 Ctrl+F: 查找
 Ctrl+H: 替换
+F3 / Shift+F3: 查找下一个 / 上一个（查找后全部匹配都会高亮）
+Esc: 清除高亮
 Ctrl+B: 新建缓冲区
 Ctrl+Tab: 切换缓冲区
 F1: 帮助"""
@@ -504,8 +979,8 @@ F1: 帮助"""
     {platform.platform()}
     {platform.python_version()}
 
-当前缓冲区: {self.current_buffer}
-缓冲区数量: {len(self.buffers)}"""
+当前缓冲区: {self.session.current}
+缓冲区数量: {len(self.session.buffers)}"""
         QMessageBox.information(self, "调试信息", debug_text)
 
 if __name__ == "__main__":
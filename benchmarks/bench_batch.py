@@ -0,0 +1,76 @@
+"""批处理模式吞吐量基准：同一批命令分别走 -s 脚本和交互式管道输入
+
+用法: python benchmarks/bench_batch.py [--lines N] [--commands N]
+"""
+import argparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EDITOR = os.path.join(ROOT, "NightNote_25.0708.1.py")
+
+
+def make_script(commands, lines, seed=0):
+    """生成插入/追加/删除/替换/查找混合的命令，行号始终落在缓冲区内"""
+    rng = random.Random(seed)
+    out = []
+    count = lines
+    for i in range(commands):
+        kind = rng.random()
+        if kind < 0.35:
+            out += [f"i {rng.randint(0, min(count, 100))}", f"inserted {i}", "."]
+            count += 1
+        elif kind < 0.55:
+            out += ["a", f"appended {i}", "."]
+            count += 1
+        elif kind < 0.85 and count > 1:
+            out.append(f"d {rng.randint(1, min(count, 100))}")
+            count -= 1
+        elif kind < 0.95:
+            out.append(f"r inserted{i % 10}$ changed")
+        else:
+            out.append(f"s appended {i - 1}$")
+    return out
+
+
+def timed(argv, stdin):
+    start = time.perf_counter()
+    proc = subprocess.run(argv, input=stdin, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    elapsed = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise SystemExit(f"{argv} exited with {proc.returncode}: {proc.stderr.strip()}")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=200_000)
+    parser.add_argument("--commands", type=int, default=5000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, "input.txt")
+        with open(source, "w", encoding="utf-8") as f:
+            f.writelines(f"line {i} lorem ipsum dolor sit amet\n" for i in range(args.lines))
+        commands = make_script(args.commands, args.lines)
+        script = os.path.join(tmp, "bench.ned")
+        with open(script, "w", encoding="utf-8") as f:
+            f.write("\n".join(commands) + "\n")
+        output = os.path.join(tmp, "output.txt")
+
+        batch = timed([sys.executable, EDITOR, "-s", script, "-o", output, source], None)
+        piped = timed([sys.executable, EDITOR, source], "\n".join(commands + [f"w {output}", "q"]) + "\n")
+        startup = timed([sys.executable, EDITOR, "-s", os.devnull, source], None)
+
+    print(f"{args.lines} lines, {args.commands} commands (startup + load {startup:.3f}s)")
+    for name, elapsed in (("batch (-s)", batch), ("interactive pipe", piped)):
+        rate = args.commands / max(elapsed - startup, 1e-9)
+        print(f"{name:<18}{elapsed:>9.3f}s{rate:>12.0f} cmd/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""缓冲区引擎基准：比较原有列表后端与绳索后端
+
+用法: python benchmarks/bench_buffer.py [--lines N] [--ops N]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from nightnote_core import BUFFER_ENGINES  # noqa: E402
+
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def run(engine, base, ops):
+    cls = BUFFER_ENGINES[engine]
+    buf = cls(base)
+    rng = random.Random(0)
+    results = {}
+    results["build"] = timed(lambda: cls(base))
+
+    def insert_top():
+        for i in range(ops):
+            buf.insert(rng.randint(0, 100), [f"inserted {i}"])
+
+    def delete_top():
+        for _ in range(ops):
+            buf.delete(rng.randint(0, 100))
+
+    def append():
+        for i in range(ops):
+            buf.extend([f"appended {i}"])
+
+    def random_read():
+        n = len(buf)
+        for _ in range(ops):
+            buf[rng.randrange(n)]
+
+    def scan():
+        for _ in buf:
+            pass
+
+    results["insert near top"] = timed(insert_top)
+    results["delete near top"] = timed(delete_top)
+    results["append"] = timed(append)
+    results["random read"] = timed(random_read)
+    results["full scan"] = timed(scan)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=2_000_000)
+    parser.add_argument("--ops", type=int, default=2000)
+    args = parser.parse_args()
+
+    base = [f"line {i} lorem ipsum dolor sit amet" for i in range(args.lines)]
+    print(f"{args.lines} lines, {args.ops} ops per test")
+    table = {engine: run(engine, base, args.ops) for engine in BUFFER_ENGINES}
+    names = list(next(iter(table.values())))
+    print(f"{'test':<18}" + "".join(f"{e:>12}" for e in table))
+    for name in names:
+        print(f"{name:<18}" + "".join(f"{table[e][name]:>11.4f}s" for e in table))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+"""命令行编辑器核心操作基准：在合成的大文件上计时并统计峰值内存，结果输出为 JSON
+
+用法: python benchmarks/bench_cli.py [--sizes 1M,100M,1G] [--shapes short,long,utf8]
+                                     [--workdir DIR] [--no-memory] [--output FILE]
+
+每个 (大小, 形状) 组合在新的子进程里跑两遍：一遍只计时，一遍开 tracemalloc 统计
+每个操作的峰值分配（tracemalloc 会拖慢速度，所以不和计时混在一起）。
+合成文件按固定种子生成并缓存在 workdir 中，重复运行结果可比。
+"""
+import argparse
+import contextlib
+import importlib.util
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EDITOR = os.path.join(ROOT, "NightNote_25.0708.1.py")
+
+SIZES = {"1M": 1 << 20, "100M": 100 << 20, "1G": 1 << 30}
+NEEDLE_EVERY = 997  # 每隔这么多行放一行 needle，供查找/替换命中
+EDIT_OPS = 100  # 插入、删除、撤销、重做各做这么多次
+
+
+def _words(rng, alphabet, count, word_len=(2, 9)):
+    return " ".join("".join(rng.choice(alphabet) for _ in range(rng.randint(*word_len)))
+                    for _ in range(count))
+
+
+def line_pool(shape, seed=0):
+    """每种形状的候选行，生成文件时循环使用"""
+    rng = random.Random(seed)
+    latin = "abcdefghijklmnopqrstuvwxyz"
+    if shape == "short":
+        return [_words(rng, latin, rng.randint(1, 5)) for _ in range(512)]
+    if shape == "long":
+        return [_words(rng, latin, rng.randint(200, 400)) for _ in range(64)]
+    if shape == "utf8":
+        cjk = [chr(c) for c in range(0x4E00, 0x4E00 + 2000)] + ["é", "ß", "ж", "😀", "🚀"]
+        return [_words(rng, cjk, rng.randint(3, 12), (1, 6)) for _ in range(512)]
+    raise ValueError(f"unknown shape {shape!r}")
+
+
+def generate(path, size, shape):
+    """生成约 size 字节的文件，已存在且大小相近时直接复用"""
+    if os.path.exists(path) and abs(os.path.getsize(path) - size) < 64 * 1024:
+        return
+    pool = line_pool(shape)
+    written = 0
+    i = 0
+    with open(path + ".tmp", "w", encoding="utf-8", newline="\n") as f:
+        block = []
+        while written < size:
+            if i % NEEDLE_EVERY == 0:
+                line = f"{i} needle {i}\n"
+            else:
+                line = f"{i} {pool[i % len(pool)]}\n"
+            block.append(line)
+            written += len(line.encode("utf-8"))
+            i += 1
+            if len(block) == 4096:
+                f.write("".join(block))
+                block = []
+        f.write("".join(block))
+    os.replace(path + ".tmp", path)
+
+
+def load_editor():
+    """文件名里带点号，不能直接 import，按路径加载"""
+    spec = importlib.util.spec_from_file_location("nightnote_cli", EDITOR)
+    module = importlib.util.module_from_spec(spec)
+    sys.path.insert(0, ROOT)
+    spec.loader.exec_module(module)
+    module.QUIET = True
+    return module
+
+
+def operations(ed, path, out_path):
+    """按顺序执行的 (名称, 调用次数, 函数)，后面的操作依赖前面留下的状态"""
+    def repeat(func, *args):
+        return lambda: [func(*args) for _ in range(EDIT_OPS)]
+
+    return [
+        ("select_file", 1, lambda: ed.select_file(path)),
+        ("write", 1, lambda: ed.write(out_path)),
+        ("search literal", 1, lambda: ed.search("needle")),
+        ("search regex", 1, lambda: ed.search(r"ne+dle \d+7$")),
+        ("replace", 1, lambda: ed.replace("needle", "pin")),
+        ("insert near top", EDIT_OPS, lambda: [ed.insert(10 + k, [f"inserted {k}"]) for k in range(EDIT_OPS)]),
+        ("delete near top", EDIT_OPS, repeat(ed.delete, 20)),
+        ("undo_last", EDIT_OPS, repeat(ed.undo_last)),
+        ("redo", EDIT_OPS, repeat(ed.redo)),
+        ("write after edits", 1, lambda: ed.write(out_path)),
+        ("switch_buffer", 2, lambda: (ed.switch_buffer(1), ed.switch_buffer(0))),
+        ("list_buffers", 1, ed.list_buffers),
+    ]
+
+
+def run_case(path, out_path, trace):
+    """在当前进程中跑一遍所有操作，返回 {操作: 结果}"""
+    ed = load_editor()
+    results = {}
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for name, calls, func in operations(ed, path, out_path):
+            if trace:
+                tracemalloc.start()
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+            entry = {"calls": calls}
+            if trace:
+                entry["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            else:
+                entry["seconds"] = elapsed
+            results[name] = entry
+    if ed.error_count:
+        raise SystemExit(f"{ed.error_count} commands failed")
+    lines, total_bytes, _ = ed.get_lines().stats()
+    summary = {"lines": lines, "bytes": total_bytes, "ops": results}
+    if resource is not None and not trace:
+        summary["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return summary
+
+
+def child(path, trace):
+    out_path = path + (".trace.out" if trace else ".out")
+    try:
+        return run_case(path, out_path, trace)
+    finally:
+        if os.path.exists(out_path):
+            os.remove(out_path)
+
+
+def run_in_child(path, trace):
+    argv = [sys.executable, os.path.abspath(__file__), "--child", path] + (["--trace"] if trace else [])
+    proc = subprocess.run(argv, stdout=subprocess.PIPE, text=True, check=True)
+    return json.loads(proc.stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1M,100M,1G", help="comma separated, from " + ",".join(SIZES))
+    parser.add_argument("--shapes", default="short,long,utf8")
+    parser.add_argument("--workdir", help="where synthetic files are cached (default: a temp dir)")
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc pass")
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--trace", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        json.dump(child(args.child, args.trace), sys.stdout)
+        return
+
+    with contextlib.ExitStack() as stack:
+        workdir = args.workdir or stack.enter_context(tempfile.TemporaryDirectory())
+        os.makedirs(workdir, exist_ok=True)
+        cases = []
+        for size_name in args.sizes.split(","):
+            for shape in args.shapes.split(","):
+                path = os.path.join(workdir, f"synthetic-{size_name}-{shape}.txt")
+                generate(path, SIZES[size_name], shape)
+                print(f"running {size_name} {shape}", file=sys.stderr)
+                case = {"size": size_name, "shape": shape, "file_bytes": os.path.getsize(path)}
+                case.update(run_in_child(path, trace=False))
+                if not args.no_memory:
+                    traced = run_in_child(path, trace=True)
+                    for name, entry in traced["ops"].items():
+                        case["ops"][name]["peak_bytes"] = entry["peak_bytes"]
+                cases.append(case)
+
+    report = {
+        "version": load_editor().__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "edit_ops": EDIT_OPS,
+        "cases": cases,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
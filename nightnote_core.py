@@ -0,0 +1,2180 @@
+"""NightNote 编辑核心：与界面无关的缓冲区存储、增量历史、查找和编辑会话，三个前端共用"""
+import codecs
+import concurrent.futures
+import itertools
+import json
+import locale
+import mmap
+import operator
+import os
+import random
+import re
+import stat
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from array import array
+from collections import namedtuple
+from functools import lru_cache
+
+# 绳索(rope)每个块的目标行数，块内插入超过 2 倍时会拆分重建
+LEAF_SIZE = 1024
+DEFAULT_ENGINE = "rope"
+
+
+def utf8_size(text):
+    """按 UTF-8 编码后的字节数；surrogateescape 保留的坏字节按原来的 1 个字节计"""
+    try:
+        return len(text.encode("utf-8", "surrogateescape"))
+    except UnicodeEncodeError:
+        return len(text.encode("utf-8", "surrogatepass"))
+
+
+def _count_lines(lines):
+    """按 UTF-8 统计 (字节数, 字符数)，每行都计入一个换行符"""
+    if not lines:
+        return 0, 0
+    text = "\n".join(lines)
+    return utf8_size(text) + 1, len(text) + 1
+
+
+class BufferBase:
+    """缓冲区公共接口，所有修改都经过 replace()"""
+
+    trigram_index = None  # 可选的 TrigramIndex，只有绳索缓冲区支持
+
+    dirty_from = None  # 自上次保存以来第一处被修改的行，None 表示未修改
+    saved = None  # 上次保存的 SavedFile 记录
+    origin = None  # 从磁盘读入时的 SavedFile 记录，未修改时会话文件只保存对它的引用
+    file_index = None  # 会话文件为 saved/origin 建的行索引缓存：((路径, 大小, 修改时间), 引用)
+    byte_count = 0  # 按 UTF-8 计、每行加一个换行符的字节数
+    char_count = 0  # 字符数，同样包含每行的换行符
+
+    def stats(self):
+        """返回 (行数, 字节数, 字符数)，O(1)"""
+        return len(self), self.byte_count, self.char_count
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def _get(self, i):
+        raise NotImplementedError
+
+    def _splice(self, start, stop, new_lines):
+        """用 new_lines 替换 [start, stop) 行，返回被删除的行"""
+        raise NotImplementedError
+
+    def iter_chunks(self, start=0, stop=None):
+        """按块产出 [start, stop) 范围内的行列表"""
+        raise NotImplementedError
+
+    def _clamp(self, start, stop):
+        n = len(self)
+        if stop is None or stop > n:
+            stop = n
+        start = max(0, min(start, stop))
+        return start, stop
+
+    def replace(self, start, stop, new_lines):
+        start, stop = self._clamp(start, stop)
+        new_lines = list(new_lines)
+        if start == stop and not new_lines:
+            return []
+        if self.dirty_from is None or start < self.dirty_from:
+            self.dirty_from = start
+        removed = self._splice(start, stop, new_lines)
+        added_bytes, added_chars = _count_lines(new_lines)
+        removed_bytes, removed_chars = _count_lines(removed)
+        self.byte_count += added_bytes - removed_bytes
+        self.char_count += added_chars - removed_chars
+        return removed
+
+    def insert(self, n, new_lines):
+        """在第 n 行之后插入（n 从 0 开始计数，0 表示最前面）"""
+        self.replace(n, n, new_lines)
+
+    def delete(self, start, stop=None):
+        if stop is None:
+            stop = start + 1
+        return self.replace(start, stop, [])
+
+    def extend(self, new_lines):
+        n = len(self)
+        self.replace(n, n, new_lines)
+
+    def iter_range(self, start=0, stop=None):
+        for chunk in self.iter_chunks(start, stop):
+            yield from chunk
+
+    def __iter__(self):
+        return self.iter_range()
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return self.to_list()[key]
+            return list(self.iter_range(start, stop))
+        n = len(self)
+        if key < 0:
+            key += n
+        if key < 0 or key >= n:
+            raise IndexError("line index out of range")
+        return self._get(key)
+
+    def __setitem__(self, i, line):
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("line index out of range")
+        self.replace(i, i + 1, [line])
+
+    def to_list(self):
+        return list(self.iter_range())
+
+    def snapshot(self):
+        """返回内容和保存状态都相同的只读副本，供后台线程读取
+
+        只复制各块的行引用，不复制、不编码字符串；之后对本缓冲区的修改不影响副本。
+        """
+        copy = RopeBuffer.__new__(RopeBuffer)
+        copy._root = _build_chunks(list(self.iter_chunks()))
+        copy.byte_count, copy.char_count = self.byte_count, self.char_count
+        copy.saved, copy.origin, copy.dirty_from = self.saved, self.origin, self.dirty_from
+        return copy
+
+
+class ListBuffer(BufferBase):
+    """原有的列表后端：中间插入/删除要移动其后所有行"""
+
+    def __init__(self, lines=()):
+        self._lines = list(lines)
+        self.byte_count, self.char_count = _count_lines(self._lines)
+
+    def __len__(self):
+        return len(self._lines)
+
+    def _get(self, i):
+        return self._lines[i]
+
+    def _splice(self, start, stop, new_lines):
+        removed = self._lines[start:stop]
+        self._lines[start:stop] = new_lines
+        return removed
+
+    def iter_chunks(self, start=0, stop=None):
+        start, stop = self._clamp(start, stop)
+        for i in range(start, stop, LEAF_SIZE * 64):
+            yield self._lines[i:min(i + LEAF_SIZE * 64, stop)]
+
+
+# 块内容每次变化都换一个新的戳记，索引据此判断块是否需要重新索引
+_stamps = itertools.count(1)
+
+
+class _Node:
+    """隐式键 treap 的节点，每个节点保存一块连续的行"""
+    __slots__ = ("lines", "left", "right", "size", "prio", "stamp")
+
+    def __init__(self, lines, prio=None):
+        self.lines = lines
+        self.left = None
+        self.right = None
+        self.size = len(lines)
+        self.prio = random.random() if prio is None else prio
+        self.stamp = next(_stamps)
+
+
+def _size(node):
+    return node.size if node is not None else 0
+
+
+def _update(node):
+    node.size = _size(node.left) + len(node.lines) + _size(node.right)
+
+
+def _merge(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if a.prio > b.prio:
+        a.right = _merge(a.right, b)
+        _update(a)
+        return a
+    b.left = _merge(a, b.left)
+    _update(b)
+    return b
+
+
+def _split(node, k):
+    """切分为 (前 k 行, 其余)，切点落在块内时把块一分为二"""
+    if node is None:
+        return None, None
+    ls = _size(node.left)
+    if k <= ls:
+        left, right = _split(node.left, k)
+        node.left = right
+        _update(node)
+        return left, node
+    k -= ls
+    n = len(node.lines)
+    if k >= n:
+        left, right = _split(node.right, k - n)
+        node.right = left
+        _update(node)
+        return node, right
+    tail = _Node(node.lines[k:])
+    node.lines = node.lines[:k]
+    node.stamp = next(_stamps)
+    right = node.right
+    node.right = None
+    _update(node)
+    return node, _merge(tail, right)
+
+
+def _build(lines):
+    """把行列表切成块并直接建成平衡的 treap，O(n)"""
+    return _build_chunks([lines[i:i + LEAF_SIZE] for i in range(0, len(lines), LEAF_SIZE)])
+
+
+def _build_chunks(chunks):
+    if not chunks:
+        return None
+    prios = sorted((random.random() for _ in chunks), reverse=True)
+    nodes = [_Node(chunk) for chunk in chunks]
+    root = None
+    # 按层序分配优先级，保证父节点优先级总是大于子节点
+    queue = [(0, len(nodes), None, False)]
+    order = 0
+    while order < len(queue):
+        lo, hi, parent, is_right = queue[order]
+        mid = (lo + hi) // 2
+        node = nodes[mid]
+        node.prio = prios[order]
+        order += 1
+        if parent is None:
+            root = node
+        elif is_right:
+            parent.right = node
+        else:
+            parent.left = node
+        if lo < mid:
+            queue.append((lo, mid, node, False))
+        if mid + 1 < hi:
+            queue.append((mid + 1, hi, node, True))
+    for lo, hi, _, _ in reversed(queue):
+        _update(nodes[(lo + hi) // 2])
+    return root
+
+
+def _collect(node, out):
+    """中序收集子树中的所有行"""
+    stack = []
+    while stack or node is not None:
+        while node is not None:
+            stack.append(node)
+            node = node.left
+        node = stack.pop()
+        out.extend(node.lines)
+        node = node.right
+    return out
+
+
+class RopeBuffer(BufferBase):
+    """按行分块的绳索：插入、删除、追加的代价为 O(log n + 块大小)"""
+
+    def __init__(self, lines=()):
+        lines = list(lines)
+        self._root = _build(lines)
+        self.byte_count, self.char_count = _count_lines(lines)
+
+    def __len__(self):
+        return _size(self._root)
+
+    def _locate(self, i):
+        """返回 (节点, 块内偏移, 从根到该节点的路径)"""
+        path = []
+        node = self._root
+        while True:
+            path.append(node)
+            ls = _size(node.left)
+            if i < ls:
+                node = node.left
+                continue
+            i -= ls
+            if i < len(node.lines):
+                return node, i, path
+            i -= len(node.lines)
+            node = node.right
+
+    def _get(self, i):
+        node, off, _ = self._locate(i)
+        return node.lines[off]
+
+    def _splice(self, start, stop, new_lines):
+        total = len(self)
+        count = stop - start
+        if not count and not new_lines:
+            return []
+        if total:
+            # 快速路径：修改范围落在同一块内时原地修改，只更新路径上的计数
+            node, off, path = self._locate(min(start, total - 1))
+            if start == total:
+                off += 1
+            remain = len(node.lines) - count + len(new_lines)
+            if off + count <= len(node.lines) and 0 < remain <= 2 * LEAF_SIZE:
+                if type(node.lines) is not list:
+                    # 映射块第一次被修改时解码成内存中的覆盖块
+                    node.lines = list(node.lines)
+                removed = node.lines[off:off + count]
+                node.lines[off:off + count] = new_lines
+                node.stamp = next(_stamps)
+                delta = len(new_lines) - count
+                for p in path:
+                    p.size += delta
+                return removed
+        left, rest = _split(self._root, start)
+        middle, right = _split(rest, count)
+        removed = _collect(middle, []) if middle is not None else []
+        self._root = _merge(_merge(left, _build(new_lines)), right)
+        return removed
+
+    def iter_nodes(self):
+        """按顺序产出 (起始行, 节点)"""
+        stack = []
+        node = self._root
+        start = 0
+        while stack or node is not None:
+            while node is not None:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            yield start, node
+            start += len(node.lines)
+            node = node.right
+
+    def iter_chunks(self, start=0, stop=None):
+        start, stop = self._clamp(start, stop)
+        remaining = stop - start
+        stack = []
+        node = self._root
+        i = start
+        while node is not None:
+            ls = _size(node.left)
+            if i < ls:
+                stack.append(node)
+                node = node.left
+                continue
+            i -= ls
+            if i < len(node.lines):
+                break
+            i -= len(node.lines)
+            node = node.right
+        while node is not None and remaining > 0:
+            chunk = node.lines[i:i + remaining]
+            remaining -= len(chunk)
+            i = 0
+            yield chunk
+            node = node.right
+            while node is not None:
+                stack.append(node)
+                node = node.left
+            node = stack.pop() if stack else None
+
+
+BUFFER_ENGINES = {
+    "list": ListBuffer,
+    "rope": RopeBuffer,
+}
+
+
+def make_buffer(lines=(), engine=None):
+    """按引擎名创建缓冲区，lines 已经是缓冲区时原样返回"""
+    if isinstance(lines, BufferBase):
+        return lines
+    return BUFFER_ENGINES[engine or DEFAULT_ENGINE](lines)
+
+
+# 历史记录默认内存预算（字节），超出后丢弃最旧的记录
+HISTORY_MAX_BYTES = 256 * 1024 * 1024
+_LINE_OVERHEAD = 56  # 每行 str 对象和列表槽位的大致开销
+
+
+def _changes_size(changes):
+    size = 0
+    for _, removed, inserted in changes:
+        size += sum(len(line) + _LINE_OVERHEAD for line in removed)
+        size += sum(len(line) + _LINE_OVERHEAD for line in inserted)
+    return size
+
+
+class Delta:
+    """一次操作的增量：按顺序执行的 (起始行, 删除的行, 插入的行) 列表"""
+    __slots__ = ("buf_idx", "operation", "changes", "file_before", "file_after", "size")
+
+    def __init__(self, buf_idx, operation, changes, file_before, file_after):
+        self.buf_idx = buf_idx
+        self.operation = operation
+        self.changes = changes
+        self.file_before = file_before
+        self.file_after = file_after
+        self.size = _changes_size(changes) + _LINE_OVERHEAD
+
+    def undo_changes(self):
+        """撤销时按顺序套用的修改，形式与 changes 相同"""
+        return [(start, inserted, removed) for start, removed, inserted in reversed(self.changes)]
+
+    def undo(self, buf):
+        for start, removed, inserted in reversed(self.changes):
+            buf.replace(start, start + len(inserted), removed)
+
+    def redo(self, buf):
+        for start, removed, inserted in self.changes:
+            buf.replace(start, start + len(removed), inserted)
+
+
+class EditJournal:
+    """增量式撤销/重做历史，撤销和重做的代价只与修改量有关"""
+
+    def __init__(self, max_bytes=HISTORY_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.undo_stack = []
+        self.redo_stack = []
+        self.used = 0
+
+    def __len__(self):
+        return len(self.undo_stack)
+
+    def record(self, buf_idx, operation, changes=(), file_before="", file_after=""):
+        for delta in self.redo_stack:
+            self.used -= delta.size
+        self.redo_stack.clear()
+        delta = Delta(buf_idx, operation, list(changes), file_before, file_after)
+        self.undo_stack.append(delta)
+        self.used += delta.size
+        self._trim()
+        return delta
+
+    def _trim(self):
+        # 至少保留最新的一条，哪怕它本身就超出预算
+        drop = 0
+        while self.used > self.max_bytes and drop < len(self.undo_stack) - 1:
+            self.used -= self.undo_stack[drop].size
+            drop += 1
+        if drop:
+            del self.undo_stack[:drop]
+
+    def undo(self, buffers, buffer_files):
+        """撤销最近一次操作，返回对应的 Delta；没有历史时返回 None"""
+        if not self.undo_stack:
+            return None
+        delta = self.undo_stack.pop()
+        delta.undo(buffers[delta.buf_idx])
+        buffer_files[delta.buf_idx] = delta.file_before
+        self.redo_stack.append(delta)
+        return delta
+
+    def redo(self, buffers, buffer_files):
+        if not self.redo_stack:
+            return None
+        delta = self.redo_stack.pop()
+        delta.redo(buffers[delta.buf_idx])
+        buffer_files[delta.buf_idx] = delta.file_after
+        self.undo_stack.append(delta)
+        return delta
+
+    def drop_buffer(self, idx, renumber=True):
+        """丢弃缓冲区 idx 的历史；缓冲区被删除时（renumber 为真）还要修正其后缓冲区的编号"""
+        for stack in (self.undo_stack, self.redo_stack):
+            kept = []
+            for delta in stack:
+                if delta.buf_idx == idx:
+                    self.used -= delta.size
+                    continue
+                if renumber and delta.buf_idx > idx:
+                    delta.buf_idx -= 1
+                kept.append(delta)
+            stack[:] = kept
+
+
+# 建立行索引时每次扫描的字节数
+INDEX_BLOCK = 16 * 1024 * 1024
+
+
+def _decode_lines(raw, encoding, errors):
+    """把若干完整行的原始字节解码并切分成行"""
+    text = raw.decode(encoding, errors)
+    parts = text.split("\n")
+    if raw.endswith(b"\n"):
+        parts.pop()
+    if "\r" in text:
+        parts = [line[:-1] if line.endswith("\r") else line for line in parts]
+    return parts
+
+
+def _ascii_compatible(encoding):
+    """换行符编码成单个 ASCII 字节、可以直接按 b"\n" 切分行的编码（BOM 之外）"""
+    encoder = codecs.getincrementalencoder(encoding)()
+    encoder.encode("a")
+    return encoder.encode("\r\n") == b"\r\n"
+
+
+class MappedFile:
+    """只读内存映射的文件和它的行起始偏移索引，行在用到时才解码
+
+    encoding 为 None 时从文件开头探测；只支持与 ASCII 兼容的编码和 \n、\r\n 换行，
+    其他文件抛出 ValueError，应整个读入。坏字节默认用 surrogateescape 保留，保存时原样写回。
+    """
+
+    def __init__(self, filename, encoding=None, errors="surrogateescape", index=None):
+        """index 为 (行偏移数组, 内容字节数, 内容字符数) 时直接采用，不再扫描文件"""
+        self.filename = filename
+        self.errors = errors
+        self._file = open(filename, "rb")
+        self._mm = None
+        try:
+            self.stat = st = os.fstat(self._file.fileno())
+            self.size = st.st_size
+            self._identity = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+            if self.size:
+                self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.encoding = encoding or sniff_encoding(self._mm[:SNIFF_BYTES] if self._mm else b"",
+                                                       self.size <= SNIFF_BYTES)
+            if not _ascii_compatible(self.encoding):
+                raise ValueError(f"{self.encoding} files cannot be memory-mapped")
+            self.newline = self._find_newline()
+            self.content_bytes = 0  # 不含行尾换行符的字节数（按 UTF-8 计）
+            self.content_chars = 0  # 不含行尾换行符的字符数
+            if index is None:
+                self.offsets = self._build_index()
+            else:
+                self.offsets, self.content_bytes, self.content_chars = index
+        except BaseException:
+            self.close()
+            raise
+
+    def _find_newline(self):
+        """第一个换行符："\n" 或 "\r\n"，没有换行符时为 None"""
+        if self._mm is None:
+            return None
+        lf = self._mm.find(b"\n")
+        if lf < 0:
+            if self._mm.find(b"\r") >= 0:
+                raise ValueError("files with CR line endings cannot be memory-mapped")
+            return None
+        return "\r\n" if lf and self._mm[lf - 1] == 0x0D else "\n"
+
+    def _build_index(self):
+        """一次顺序扫描找出所有换行符，offsets[i] 为第 i 行的起始字节
+
+        同一次扫描里顺便统计换行符，并解码一遍得到字符数，供缓冲区统计使用；
+        UTF-8 文件的字节数就是文件大小，其他编码的文件按解码后的文本计。
+        坏字节和 _count_lines 一样按 1 个字节、1 个字符计。
+        """
+        offsets = array("I" if self.size < 2 ** 32 else "Q", [0])
+        pos = 0
+        terminators = 0
+        last = b""
+        utf8 = codecs.lookup(self.encoding).name == "utf-8"
+        decoder = codecs.getincrementaldecoder(self.encoding)(self.errors)
+        utf8_bytes = chars = 0
+        while pos < self.size:
+            block = self._mm[pos:pos + INDEX_BLOCK]
+            parts = block.split(b"\n")
+            parts.pop()
+            lengths = map(operator.add, map(len, parts), itertools.repeat(1))
+            offsets.extend(itertools.islice(itertools.accumulate(lengths, initial=pos), 1, None))
+            terminators += len(parts) + block.count(b"\r\n")
+            if last == b"\r" and block.startswith(b"\n"):
+                terminators += 1
+            text = decoder.decode(block, pos + len(block) >= self.size)
+            chars += len(text)
+            if not utf8:
+                utf8_bytes += utf8_size(text)
+            last = block[-1:]
+            pos += len(block)
+        if offsets[-1] != self.size:
+            offsets.append(self.size)
+        self.content_bytes = (self.size if utf8 else utf8_bytes) - terminators
+        self.content_chars = chars - terminators
+        return offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def line(self, i):
+        raw = self._mm[self.offsets[i]:self.offsets[i + 1]]
+        if raw.endswith(b"\n"):
+            raw = raw[:-1]
+        if raw.endswith(b"\r"):
+            raw = raw[:-1]
+        return raw.decode(self.encoding, self.errors)
+
+    def lines(self, start, stop):
+        """一次解码 [start, stop) 行"""
+        if start >= stop:
+            return []
+        return _decode_lines(self._mm[self.offsets[start]:self.offsets[stop]], self.encoding, self.errors)
+
+    def unchanged_on_disk(self):
+        """磁盘上同名文件是否仍是映射的那一个（其他进程可以直接按偏移读取）"""
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return False
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns) == self._identity
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        self._file.close()
+
+
+class _MappedLines:
+    """指向 MappedFile 中一段行的惰性块，切片不解码，迭代时才解码"""
+    __slots__ = ("source", "start", "stop")
+
+    def __init__(self, source, start, stop):
+        self.source = source
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, _ = key.indices(self.stop - self.start)
+            return _MappedLines(self.source, self.start + start, self.start + max(start, stop))
+        return self.source.line(self.start + key)
+
+    def __iter__(self):
+        return iter(self.source.lines(self.start, self.stop))
+
+
+class MappedBuffer(RopeBuffer):
+    """基于内存映射的惰性缓冲区：打开时只建立行索引，被修改的块才转成内存覆盖块"""
+
+    def __init__(self, source):
+        self.source = source
+        n = len(source)
+        self._root = _build_chunks([_MappedLines(source, i, min(i + LEAF_SIZE, n))
+                                    for i in range(0, n, LEAF_SIZE)])
+        self.byte_count = source.content_bytes + n
+        self.char_count = source.content_chars + n
+
+    def materialize(self):
+        """把所有行解码进内存并解除对映射文件的依赖"""
+        self._root = _build(self.to_list())
+        self.source.close()
+
+
+# 批量读入时每次从流中读取的字符数
+READ_CHUNK_CHARS = 1024 * 1024
+
+
+def iter_read_lines(f, size=READ_CHUNK_CHARS):
+    """从文本流按大块读到结尾，每块整体切分后产出一个行列表（去掉 \n 和 \r\n）
+
+    跨块的半行留到下一块；不逐行调用 readline/input，适合一次性读入大量文本。
+    """
+    return _split_blocks(iter(lambda: f.read(size), ""))
+
+
+def _split_blocks(blocks):
+    """把依次到达的文本块切分成行，每块产出一个行列表"""
+    pending = []  # 尚未遇到换行符的行首部分
+    for block in blocks:
+        if "\n" not in block:
+            pending.append(block)
+            continue
+        parts = block.split("\n")
+        if pending:
+            pending.append(parts[0])
+            parts[0] = "".join(pending)
+            pending = []
+        pending.append(parts.pop())
+        yield _strip_cr(parts)
+    tail = "".join(pending)
+    if tail:
+        yield _strip_cr([tail])
+
+
+def _strip_cr(lines):
+    if any(line.endswith("\r") for line in lines):
+        return [line[:-1] if line.endswith("\r") else line for line in lines]
+    return lines
+
+
+def read_lines_from(chunks):
+    """把逐块产出的行列表接成一个列表"""
+    lines = []
+    for part in chunks:
+        lines.extend(part)
+    return lines
+
+
+def read_lines(f, size=READ_CHUNK_CHARS):
+    """读到流结尾并返回所有行"""
+    return read_lines_from(iter_read_lines(f, size))
+
+
+# 探测编码时读取的文件开头字节数，之后解码时每次读取的字节数
+SNIFF_BYTES = 64 * 1024
+READ_CHUNK_BYTES = 1024 * 1024
+# 没有 BOM 时依次尝试的编码，之后再试本地默认编码
+DETECT_ENCODINGS = ("utf-8", "gb18030")
+_BOMS = (
+    (codecs.BOM_UTF32_LE, "utf-32"),  # 要在 UTF-16 LE 之前判断，它们的开头相同
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+)
+
+
+def sniff_encoding(head, final=False):
+    """从文件开头的字节推断编码：先看 BOM，再看 UTF-16 的零字节分布，最后依次试解码
+
+    final 表示 head 就是整个文件；否则允许末尾截断半个字符。都解码失败时返回 UTF-8，
+    此时坏字节由 surrogateescape 保留，保存时原样写回。
+    """
+    for bom, encoding in _BOMS:
+        if head.startswith(bom):
+            return encoding
+    half = len(head) // 2
+    if half and b"\x00" in head:
+        even, odd = head[0::2].count(0), head[1::2].count(0)
+        if odd * 2 > half and even * 10 < half:
+            return "utf-16-le"
+        if even * 2 > half and odd * 10 < half:
+            return "utf-16-be"
+    candidates = list(DETECT_ENCODINGS)
+    preferred = codecs.lookup(locale.getpreferredencoding(False)).name
+    if preferred not in candidates:
+        candidates.append(preferred)
+    for encoding in candidates:
+        try:
+            codecs.getincrementaldecoder(encoding)("strict").decode(head, final)
+        except UnicodeDecodeError:
+            continue
+        return encoding
+    return "utf-8"
+
+
+class TextFile:
+    """按块增量解码的文本文件：打开时从开头一块字节探测编码，解码时顺便认出换行符
+
+    迭代时每块产出一个行列表（去掉换行符），同一时刻只有一块原始字节在内存里。
+    encoding 为 None 时自动探测；坏字节默认用 surrogateescape 保留。
+    """
+
+    def __init__(self, filename, encoding=None, errors="surrogateescape", size=READ_CHUNK_BYTES):
+        self.filename = filename
+        self.errors = errors
+        self.size = size
+        self._file = open(filename, "rb")
+        try:
+            self.stat = os.fstat(self._file.fileno())
+            self._head = self._file.read(max(size, SNIFF_BYTES))
+            self.encoding = encoding or sniff_encoding(self._head[:SNIFF_BYTES], self.stat.st_size <= SNIFF_BYTES)
+        except BaseException:
+            self._file.close()
+            raise
+        self.newline = None  # 第一个换行符："\n"、"\r\n" 或 "\r"；还没遇到时为 None
+        self._last = ""  # 上一块的最后一个字符，块边界正好在 \r\n 中间时用
+
+    def tell(self):
+        """已经读入的字节数，用于显示进度"""
+        return self._file.tell()
+
+    def __iter__(self):
+        return _split_blocks(self._blocks())
+
+    def _blocks(self):
+        decoder = codecs.getincrementaldecoder(self.encoding)(self.errors)
+        data, self._head = self._head, b""
+        while data:
+            yield self._newlines(decoder.decode(data))
+            data = self._file.read(self.size)
+        yield self._newlines(decoder.decode(b"", True))
+
+    def _newlines(self, text):
+        if self.newline is None and text:
+            lf = text.find("\n")
+            cr = text.find("\r")
+            if lf >= 0:
+                self.newline = "\r\n" if (text[lf - 1] if lf else self._last) == "\r" else "\n"
+            elif 0 <= cr < len(text) - 1:
+                self.newline = "\r"  # 只用 \r 分行的旧式文件
+            self._last = text[-1]
+        if self.newline == "\r":
+            text = text.replace("\r", "\n")
+        return text
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# 保存时每次写入的大致字节数
+SAVE_CHUNK_BYTES = 1024 * 1024
+
+SavedFile = namedtuple("SavedFile", "path size mtime_ns lines encoding newline")
+
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def _encoded_chunks(buf, start, encoding, newline, errors):
+    """把 start 行之后的内容拼接成约 SAVE_CHUNK_BYTES 的块并编码
+
+    用增量编码器，UTF-16、utf-8-sig 之类的 BOM 只在开头写一次。
+    """
+    encode = codecs.getincrementalencoder(encoding)(errors).encode
+    pending = []
+    size = 0
+    for chunk in buf.iter_chunks(start):
+        if not len(chunk):
+            continue
+        text = newline.join(chunk)
+        pending.append(text)
+        size += len(text)
+        if size >= SAVE_CHUNK_BYTES:
+            yield encode(newline.join(pending) + newline)
+            pending = []
+            size = 0
+    if pending:
+        yield encode(newline.join(pending) + newline, True)
+
+
+def _fsync_dir(directory):
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return  # Windows 等平台不能打开目录
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _write_atomic(buf, path, encoding, newline, errors):
+    """写入同目录下的临时文件，fsync 后改名覆盖目标"""
+    directory = os.path.dirname(path)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix="." + os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.writelines(_encoded_chunks(buf, 0, encoding, newline, errors))
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+        except FileNotFoundError:
+            mode = 0o666 & ~_UMASK
+        os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    _fsync_dir(directory)
+
+
+def _offset_from_end(f, size, back, sep=b"\n"):
+    """返回倒数第 back 个换行符之后的位置，sep 是换行符的最后一个字节"""
+    pos = size
+    while back > 0 and pos > 0:
+        step = min(SAVE_CHUNK_BYTES, pos)
+        pos -= step
+        f.seek(pos)
+        block = f.read(step)
+        found = block.count(sep)
+        if found >= back:
+            idx = len(block)
+            for _ in range(back):
+                idx = block.rindex(sep, 0, idx)
+            return pos + idx + 1
+        back -= found
+    return pos
+
+
+def _write_tail(buf, path, start, saved, errors):
+    """原地从第 start 行开始重写文件，之前的内容保持不动"""
+    with open(path, "r+b") as f:
+        size = f.seek(0, os.SEEK_END)
+        # 文件以换行结尾，第 start 行的起点在倒数第 (lines - start + 1) 个换行之后
+        f.seek(_offset_from_end(f, size, saved.lines - start + 1, saved.newline[-1].encode("ascii")))
+        f.writelines(_encoded_chunks(buf, start, saved.encoding, saved.newline, errors))
+        f.truncate()
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def mark_loaded(buf, filename, encoding, st, newline=None):
+    """记录缓冲区刚从 filename 整个读入、与磁盘内容一致；st 是读入前的 os.stat 结果
+
+    encoding 和 newline 是文件原来的编码和换行符，之后保存时默认沿用。
+    """
+    buf.origin = SavedFile(os.path.realpath(filename), st.st_size, st.st_mtime_ns, len(buf),
+                           encoding or locale.getpreferredencoding(False), newline)
+    buf.dirty_from = None
+
+
+def mark_saved(buf, filename, encoding, newline):
+    """记录缓冲区当前内容与磁盘上的文件一致"""
+    path = os.path.realpath(filename)
+    st = os.stat(path)
+    buf.saved = SavedFile(path, st.st_size, st.st_mtime_ns, len(buf), encoding, newline)
+    buf.dirty_from = None
+
+
+def text_format(buf):
+    """缓冲区读入或上次保存时文件的 (编码, 换行符)，不知道的项为 None"""
+    record = buf.saved or buf.origin
+    if record is None:
+        return None, None
+    return record.encoding, record.newline
+
+
+def save_buffer(buf, filename, encoding=None, newline=None, errors="surrogateescape", incremental=True):
+    """保存缓冲区，返回实际采用的方式："skipped"、"tail" 或 "full"
+
+    encoding 和 newline 默认沿用文件原来的（见 text_format），没有时用本地默认编码和 os.linesep；
+    读入时按 surrogateescape 保留的坏字节原样写回。
+    自上次保存后未修改且磁盘文件未被改动时直接跳过；只修改了后半部分时
+    （incremental 为真）原地从第一处修改的行开始重写；否则写临时文件再改名覆盖。
+    """
+    file_encoding, file_newline = text_format(buf)
+    encoding = encoding or file_encoding or locale.getpreferredencoding(False)
+    newline = newline or file_newline or os.linesep
+    path = os.path.realpath(filename)
+    saved = buf.saved
+    on_disk = None
+    if saved is not None and saved.path == path:
+        try:
+            st = os.stat(path)
+            on_disk = (st.st_size, st.st_mtime_ns)
+        except OSError:
+            pass
+    same_file = (on_disk == (saved.size, saved.mtime_ns) and saved.encoding == encoding
+                 and saved.newline == newline) if on_disk else False
+    if same_file and buf.dirty_from is None:
+        return "skipped"
+    start = min(buf.dirty_from, saved.lines) if same_file else 0
+    if (incremental and same_file and start * 2 >= saved.lines
+            and newline.encode(encoding) == newline.encode("ascii")):
+        _write_tail(buf, path, start, saved, errors)
+        result = "tail"
+    else:
+        _write_atomic(buf, path, encoding, newline, errors)
+        result = "full"
+    mark_saved(buf, path, encoding, newline)
+    return result
+
+
+class SaveJob:
+    """一次保存：创建时在当前线程给缓冲区拍快照，run() 可以放到后台线程编码、写盘，
+    结束后回到当前线程由 Session.finish_save() 把保存状态交还给缓冲区"""
+
+    def __init__(self, buf, filename, operation, incremental=True, **kwargs):
+        self.buf = buf
+        self.snapshot = buf.snapshot()
+        self.filename = filename
+        self.operation = operation
+        self.incremental = incremental
+        self.kwargs = kwargs
+        self.result = None
+        self.error = None
+        # 之后的修改位置相对快照重新记录，保存失败时再合并回去
+        buf.dirty_from = None
+
+    def run(self):
+        try:
+            self.result = save_buffer(self.snapshot, self.filename, incremental=self.incremental, **self.kwargs)
+        except Exception as e:
+            self.error = e
+        return self.result
+
+
+# 编译好的查找模式缓存条数
+PATTERN_CACHE_SIZE = 128
+_REGEX_META = frozenset(".^$*+?{}[]\\|()")
+
+
+def is_literal(pattern):
+    """模式里没有正则元字符，可以按字面查找（只看字符，不编译，对任何正则方言都适用）"""
+    return bool(pattern) and _REGEX_META.isdisjoint(pattern)
+
+
+def _is_word_char(ch):
+    return ch.isalnum() or ch == "_"
+
+
+class Matcher:
+    r"""查找模式：不含正则元字符时走 str.find/in 快速路径，否则用编译好的正则
+
+    两条路径的语义一致：whole_word 等价于 (?<!\w)模式(?!\w)，
+    ignore_case 只在模式和文本都是 ASCII 时走快速路径。
+    """
+
+    def __init__(self, pattern, ignore_case=False, whole_word=False):
+        self.pattern = pattern
+        self.ignore_case = ignore_case
+        self.whole_word = whole_word
+        self.literal = is_literal(pattern)
+        source = re.escape(pattern) if self.literal else pattern
+        if whole_word:
+            source = r"(?<!\w)(?:" + source + r")(?!\w)"
+        self.regex = re.compile(source, re.IGNORECASE if ignore_case else 0)
+        self._folded = pattern.lower()
+        self._fold_ok = ignore_case and pattern.isascii()
+
+    def _literal_text(self, text):
+        """返回快速路径使用的 (文本, 模式)，无法走快速路径时返回 None"""
+        if not self.literal:
+            return None
+        if not self.ignore_case:
+            return text, self.pattern
+        if self._fold_ok and text.isascii():
+            return text.lower(), self._folded
+        return None
+
+    def _find_word(self, text, pat, pos):
+        end = len(pat)
+        while True:
+            i = text.find(pat, pos)
+            if i < 0:
+                return -1
+            if not ((i > 0 and _is_word_char(text[i - 1]))
+                    or (i + end < len(text) and _is_word_char(text[i + end]))):
+                return i
+            pos = i + 1
+
+    def search(self, line):
+        fast = self._literal_text(line)
+        if fast is None:
+            return self.regex.search(line) is not None
+        text, pat = fast
+        if self.whole_word:
+            return self._find_word(text, pat, 0) >= 0
+        return pat in text
+
+    def finditer(self, text):
+        """依次产出所有不重叠匹配的 (start, end)"""
+        fast = self._literal_text(text)
+        if fast is None:
+            for m in self.regex.finditer(text):
+                yield m.span()
+            return
+        text, pat = fast
+        pos = 0
+        while True:
+            i = self._find_word(text, pat, pos) if self.whole_word else text.find(pat, pos)
+            if i < 0:
+                return
+            pos = i + len(pat)
+            yield i, pos
+
+    def subn(self, replacement, text):
+        if (self.literal and not self.ignore_case and not self.whole_word
+                and "\\" not in replacement):
+            count = text.count(self.pattern)
+            return (text.replace(self.pattern, replacement), count) if count else (text, 0)
+        return self.regex.subn(replacement, text)
+
+    def grep(self, chunks, start=0):
+        """在按块给出的行中查找，产出 (行号, 行)，行号从 start 开始计
+
+        纯文本模式先在整块拼接后的文本里判断，整块没有命中就直接跳过。
+        """
+        plain = self.literal and not self.ignore_case and not self.whole_word
+        pat = self.pattern
+        search = self.regex.search if not self.literal else self.search
+        idx = start
+        for chunk in chunks:
+            if type(chunk) is not list:
+                chunk = list(chunk)
+            if plain:
+                if pat in "\n".join(chunk):
+                    for i, line in enumerate(chunk):
+                        if pat in line:
+                            yield idx + i, line
+            else:
+                for i, line in enumerate(chunk):
+                    if search(line):
+                        yield idx + i, line
+            idx += len(chunk)
+
+
+@lru_cache(maxsize=PATTERN_CACHE_SIZE)
+def get_matcher(pattern, ignore_case=False, whole_word=False):
+    """取得（缓存的）Matcher，正则无效时抛出 re.error"""
+    return Matcher(pattern, ignore_case, whole_word)
+
+
+try:
+    from re import _parser as _sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse as _sre_parse
+
+
+def _literal_runs(pattern):
+    """找出正则中每次匹配都必须出现的连续字面量片段，无法判断时返回空列表"""
+    try:
+        parsed = _sre_parse.parse(pattern)
+    except Exception:
+        return []
+    if parsed.state.flags & re.IGNORECASE:
+        return []
+    runs = []
+    current = []
+
+    def flush():
+        if current:
+            runs.append("".join(current))
+            current.clear()
+
+    def walk(items):
+        for op, av in items:
+            if op is _sre_parse.LITERAL:
+                current.append(chr(av))
+            elif op is _sre_parse.SUBPATTERN and not av[1] & re.IGNORECASE:
+                walk(av[-1])
+            else:
+                flush()
+
+    walk(parsed)
+    flush()
+    return runs
+
+
+def _required_trigrams(matcher):
+    """匹配的行里必定出现的三元组；不能用索引筛选时返回 None
+
+    忽略大小写的查找不走索引：正则的大小写等价关系（如 K 与开尔文符号）
+    无法可靠地映射成三元组。
+    """
+    if matcher.ignore_case:
+        return None
+    runs = [matcher.pattern] if matcher.literal else _literal_runs(matcher.pattern)
+    required = set()
+    for run in runs:
+        required.update(zip(run, run[1:], run[2:]))
+    return required or None
+
+
+def _chunk_trigrams(lines):
+    text = "\n".join(lines)
+    return set(zip(text, text[1:], text[2:]))
+
+
+def _pack(stamps):
+    """把块戳记列表压缩成字节串"""
+    return zlib.compress(array("Q", sorted(stamps)).tobytes(), 1)
+
+
+def _unpack(blob):
+    stamps = array("Q")
+    stamps.frombytes(zlib.decompress(blob))
+    return stamps
+
+
+class TrigramIndex:
+    """绳索缓冲区的三元组索引：三元组 -> 含有它的块的压缩戳记列表
+
+    以块而不是行号为单位，插入删除不会让已有的索引项失效；块被修改后戳记
+    改变，下次查找时只重新索引这些块。废弃的戳记超过一半时整体重建。
+    """
+
+    def __init__(self, buf):
+        self.buf = buf
+        self.rebuild()
+
+    def rebuild(self):
+        begin = time.perf_counter()
+        postings = {}
+        self.indexed = set()
+        for _, node in self.buf.iter_nodes():
+            for tri in _chunk_trigrams(node.lines):
+                postings.setdefault(tri, []).append(node.stamp)
+            self.indexed.add(node.stamp)
+        self.postings = {tri: _pack(stamps) for tri, stamps in postings.items()}
+        self.added = {}  # 建立索引后新增块的三元组 -> 戳记集合
+        self.build_seconds = time.perf_counter() - begin
+
+    def _refresh(self):
+        """索引建立后被修改或新增的块补充进索引"""
+        live = 0
+        for _, node in self.buf.iter_nodes():
+            live += 1
+            if node.stamp in self.indexed:
+                continue
+            for tri in _chunk_trigrams(node.lines):
+                self.added.setdefault(tri, set()).add(node.stamp)
+            self.indexed.add(node.stamp)
+        if len(self.indexed) > 2 * live + 64:
+            self.rebuild()
+
+    def _lookup(self, tri):
+        stamps = set(_unpack(self.postings[tri])) if tri in self.postings else set()
+        return stamps | self.added.get(tri, set())
+
+    def candidates(self, matcher):
+        """产出可能含有匹配的 (起始行, 块)；模式无法利用索引时产出全部块"""
+        required = _required_trigrams(matcher)
+        if required is None:
+            for start, node in self.buf.iter_nodes():
+                yield start, node.lines
+            return
+        self._refresh()
+        found = None
+        for tri in sorted(required, key=lambda t: len(self.postings.get(t, b""))):
+            found = self._lookup(tri) if found is None else found & self._lookup(tri)
+            if not found:
+                return
+        for start, node in self.buf.iter_nodes():
+            if node.stamp in found:
+                yield start, node.lines
+
+    def memory(self):
+        """索引占用内存的估计值（字节）"""
+        size = sys.getsizeof(self.postings) + sys.getsizeof(self.indexed)
+        size += sum(len(blob) + 100 for blob in self.postings.values())
+        size += sum(sys.getsizeof(stamps) + 100 for stamps in self.added.values())
+        return size
+
+
+def grep_buffer(buf, matcher):
+    """查找一个缓冲区，返回 [(行号, 行)]，有三元组索引时只查候选块"""
+    index = getattr(buf, "trigram_index", None)
+    if index is None:
+        return list(matcher.grep(buf.iter_chunks()))
+    hits = []
+    for start, chunk in index.candidates(matcher):
+        hits.extend(matcher.grep([chunk], start))
+    return hits
+
+
+# 行数少于此值的缓冲区直接在本进程查找，避免进程池开销
+PARALLEL_MIN_LINES = 200_000
+# 每个并行任务负责的行数
+PARALLEL_CHUNK_LINES = 100_000
+SEARCH_WORKERS = None  # None 表示使用本进程可用的全部 CPU
+_pool = None
+
+
+def _search_workers():
+    if SEARCH_WORKERS:
+        return SEARCH_WORKERS
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        _pool = concurrent.futures.ProcessPoolExecutor(_search_workers())
+    return _pool
+
+
+def _job_chunks(pieces):
+    for piece in pieces:
+        if isinstance(piece, tuple):
+            # 仍映射在磁盘文件上的块只传文件名和字节范围，由子进程自己读取
+            filename, begin, end, encoding, errors = piece
+            with open(filename, "rb") as f:
+                f.seek(begin)
+                yield _decode_lines(f.read(end - begin), encoding, errors)
+        else:
+            yield piece
+
+
+def _grep_job(pattern, ignore_case, whole_word, pieces, start):
+    matcher = get_matcher(pattern, ignore_case, whole_word)
+    return list(matcher.grep(_job_chunks(pieces), start))
+
+
+def _search_jobs(buf):
+    """把缓冲区切成约 PARALLEL_CHUNK_LINES 行的任务，产出 (起始行, 块列表)"""
+    on_disk = {}
+    pieces = []
+    count = 0
+    start = 0
+    for chunk in buf.iter_chunks():
+        if isinstance(chunk, _MappedLines):
+            src = chunk.source
+            if src not in on_disk:
+                on_disk[src] = src.unchanged_on_disk()
+        if isinstance(chunk, _MappedLines) and on_disk[src]:
+            begin, end = src.offsets[chunk.start], src.offsets[chunk.stop]
+            last = pieces[-1] if pieces else None
+            if isinstance(last, tuple) and last[0] == src.filename and last[2] == begin:
+                pieces[-1] = (last[0], last[1], end, last[3], last[4])
+            else:
+                pieces.append((src.filename, begin, end, src.encoding, src.errors))
+        else:
+            pieces.append(list(chunk))
+        count += len(chunk)
+        if count >= PARALLEL_CHUNK_LINES:
+            yield start, pieces
+            start += count
+            pieces = []
+            count = 0
+    if pieces:
+        yield start, pieces
+
+
+def parallel_grep(buffers, pattern, ignore_case=False, whole_word=False):
+    """在多个缓冲区中查找，返回按 (缓冲区, 行号) 排序的 [(缓冲区编号, 行号, 行)]
+
+    大缓冲区按行切块交给进程池并行查找，小缓冲区直接在本进程查找。只有一个 CPU，
+    或者是走 str 快速路径的纯文本模式时（把一块行传给子进程比在本进程查找还慢）也不用进程池。
+    正则无效时抛出 re.error。
+    """
+    matcher = get_matcher(pattern, ignore_case, whole_word)
+    serial = (_search_workers() <= 1
+              or (matcher.literal and not ignore_case and not whole_word))
+    pending = []
+    try:
+        for idx, buf in enumerate(buffers):
+            if (serial or len(buf) < PARALLEL_MIN_LINES
+                    or getattr(buf, "trigram_index", None) is not None):
+                pending.append((idx, grep_buffer(buf, matcher)))
+                continue
+            pool = _get_pool()
+            for start, pieces in _search_jobs(buf):
+                pending.append((idx, pool.submit(_grep_job, pattern, ignore_case, whole_word, pieces, start)))
+        results = []
+        for idx, hits in pending:
+            if isinstance(hits, concurrent.futures.Future):
+                hits = hits.result()
+            results.extend((idx, line_idx, line) for line_idx, line in hits)
+        return results
+    except (OSError, concurrent.futures.BrokenExecutor):
+        # 进程池不可用时退回单进程查找
+        return [(idx, line_idx, line) for idx, buf in enumerate(buffers)
+                for line_idx, line in grep_buffer(buf, matcher)]
+
+
+def text_to_lines(text):
+    """把编辑框里的整段文本切成行；空文本对应空缓冲区"""
+    return text.split("\n") if text else []
+
+
+def lines_to_text(buf):
+    """把缓冲区拼回编辑框用的整段文本（行间用 \n 分隔，末尾不加换行）"""
+    return "\n".join(["\n".join(chunk) for chunk in buf.iter_chunks() if len(chunk)])
+
+
+def text_edits(changes, line_count):
+    """把按顺序套用到缓冲区的 changes 换算成编辑框文本上的编辑，界面据此只更新变化的部分
+
+    line_count 是套用全部 changes 之后的行数。依次产出 (起始行, 起始列, 结束行, 结束列, 文本)，
+    行列从 0 开始，列为 None 表示行尾；每个编辑先删除区间，再在起点插入文本，按顺序套用。
+    首尾相同的行不动；只改了一行时再去掉行内相同的前后缀，但行里有 BMP 以外的字符时不做，
+    因为编辑框按 UTF-16 计列。
+    """
+    n = line_count - sum(len(inserted) - len(removed) for _, removed, inserted in changes)
+    for start, removed, inserted in changes:
+        limit = min(len(removed), len(inserted))
+        head = 0
+        while head < limit and removed[head] == inserted[head]:
+            head += 1
+        tail = 0
+        while tail < limit - head and removed[-1 - tail] == inserted[-1 - tail]:
+            tail += 1
+        old = removed[head:len(removed) - tail]
+        new = inserted[head:len(inserted) - tail]
+        at = start + head
+        if old and new:
+            a, b = old[0], new[0]
+            if len(old) == len(new) == 1 and max(a + b, default="") <= "\uffff":
+                limit = min(len(a), len(b))
+                prefix = 0
+                while prefix < limit and a[prefix] == b[prefix]:
+                    prefix += 1
+                suffix = 0
+                while suffix < limit - prefix and a[-1 - suffix] == b[-1 - suffix]:
+                    suffix += 1
+                yield at, prefix, at, len(a) - suffix, b[prefix:len(b) - suffix]
+            else:
+                yield at, 0, at + len(old) - 1, None, "\n".join(new)
+        elif new:
+            # 纯插入：插在某行之前，或接在最后一行之后，或填进空文本
+            if at < n:
+                yield at, 0, at, 0, "\n".join(new) + "\n"
+            elif n:
+                yield n - 1, None, n - 1, None, "\n" + "\n".join(new)
+            else:
+                yield 0, 0, 0, 0, "\n".join(new)
+        elif old:
+            # 纯删除：连同一个换行符一起删掉
+            stop = at + len(old)
+            if stop < n:
+                yield at, 0, stop, 0, ""
+            elif at:
+                yield at - 1, None, stop - 1, None, ""
+            else:
+                yield 0, 0, stop - 1, None, ""
+        n += len(inserted) - len(removed)
+
+
+def diff_lines(buf, new_lines):
+    """比较 buf 与 new_lines，返回需要替换的最小连续区间 (start, stop_old, stop_new)
+
+    先逐块比较公共前缀，再把旧行 i 与新行 i + delta 对齐找公共后缀，块内容相同时
+    整块在 C 层比较。内容完全相同时返回 None。
+    """
+    delta = len(new_lines) - len(buf)
+    start = 0
+    for chunk in buf.iter_chunks():
+        if type(chunk) is not list:
+            chunk = list(chunk)
+        part = new_lines[start:start + len(chunk)]
+        if part == chunk:
+            start += len(chunk)
+            continue
+        for old, new in zip(chunk, part):
+            if old != new:
+                break
+            start += 1
+        break
+    # 后缀不能与前缀重叠：旧行号和对应的新行号都不能小于 start
+    limit = max(start, start - delta)
+    stop_old = limit
+    i = limit
+    for chunk in buf.iter_chunks(limit):
+        if type(chunk) is not list:
+            chunk = list(chunk)
+        part = new_lines[i + delta:i + delta + len(chunk)]
+        if part != chunk:
+            for k in range(len(chunk) - 1, -1, -1):
+                if chunk[k] != part[k]:
+                    stop_old = i + k + 1
+                    break
+        i += len(chunk)
+    stop_new = stop_old + delta
+    if stop_old == start and stop_new == start:
+        return None
+    return start, stop_old, stop_new
+
+
+class Session:
+    """无界面的编辑会话：缓冲区、对应的文件名、增量历史和操作记录
+
+    命令行版和两个图形界面都通过它修改内容，界面只负责显示和交互。
+    """
+
+    def __init__(self, history_bytes=HISTORY_MAX_BYTES, engine=None):
+        self.engine = engine
+        self.buffers = [make_buffer(engine=engine)]
+        self.buffer_files = [""]
+        self.current = 0
+        self.history = EditJournal(history_bytes)
+        self.operation_history = []  # (操作, 缓冲区编号)
+        # 最近一次修改：(缓冲区编号, 按顺序套用的 changes)，整体替换缓冲区时为 None
+        self.last_edit = None
+        # 崩溃恢复用的 Journal，不为 None 时每个修改在套用前先写一条记录
+        self.journal = None
+
+    def _log(self, kind, *payload):
+        if self.journal is not None:
+            self.journal.append(kind, payload)
+
+    @property
+    def buffer(self):
+        return self.buffers[self.current]
+
+    @property
+    def filename(self):
+        return self.buffer_files[self.current]
+
+    def record(self, operation, changes=(), file_before=None, buf_idx=None):
+        """把缓冲区 buf_idx（默认当前缓冲区）的一次操作记入历史"""
+        if buf_idx is None:
+            buf_idx = self.current
+        filename = self.buffer_files[buf_idx]
+        if file_before is None:
+            file_before = filename
+        changes = list(changes)
+        self.history.record(buf_idx, operation, changes, file_before, filename)
+        self.operation_history.append((operation, buf_idx))
+        self.last_edit = (buf_idx, changes)
+
+    def edit(self, operation, start, stop, new_lines, filename=None):
+        """用 new_lines 替换当前缓冲区 [start, stop) 行并记一条历史，返回被删除的行
+
+        filename 不为 None 时同时改变缓冲区对应的文件名，撤销时一并恢复。
+        """
+        self._log("E", self.current, operation, start, stop, new_lines, filename)
+        return self._edit(operation, start, stop, new_lines, filename)
+
+    def _edit(self, operation, start, stop, new_lines, filename=None):
+        file_before = self.buffer_files[self.current]
+        if filename is not None:
+            self.buffer_files[self.current] = filename
+        removed = self.buffer.replace(start, stop, new_lines)
+        self.record(operation, [(start, removed, new_lines)], file_before)
+        return removed
+
+    def read_file(self, operation, n, filename, encoding=None):
+        """把文件读入并插到当前缓冲区第 n 行之后，记一条历史，返回读入的行
+
+        Journal 里和 open 一样只记文件名、大小和修改时间，不记内容。
+        """
+        with TextFile(filename, encoding) as f:
+            new_lines = read_lines_from(f)
+        if new_lines:
+            st = f.stat
+            self._log("R", self.current, operation, n, filename, encoding, st.st_size, st.st_mtime_ns)
+            self._edit(operation, n, n, new_lines)
+        return new_lines
+
+    def sync(self, text, operation):
+        """把编辑框里的文本同步进当前缓冲区，只记录变化的行；没有变化时返回 None"""
+        new_lines = text_to_lines(text)
+        changed = diff_lines(self.buffer, new_lines)
+        if changed is not None:
+            start, stop_old, stop_new = changed
+            self.edit(operation, start, stop_old, new_lines[start:stop_new])
+        return changed
+
+    def load(self, lines, filename=""):
+        """用 lines（行列表或缓冲区）替换当前缓冲区，不可撤销，该缓冲区原有历史作废"""
+        if self.journal is not None:
+            self._log("L", self.current, lines if isinstance(lines, list) else list(lines), filename)
+        self._load(lines, filename)
+
+    def _load(self, lines, filename):
+        self.buffers[self.current] = make_buffer(lines, self.engine)
+        self.buffer_files[self.current] = filename
+        self.history.drop_buffer(self.current, renumber=False)
+        self.last_edit = None
+
+    def open(self, filename, encoding=None, mapped=False):
+        """把文件读入当前缓冲区（mapped 为真时内存映射），不可撤销，返回新的缓冲区
+
+        encoding 为 None 时自动探测，探测到的编码和换行符在保存时沿用。Journal 里只记文件名、大小和修改时间，不记内容。
+        """
+        if mapped:
+            f = MappedFile(filename, encoding)
+            buf = MappedBuffer(f)
+        else:
+            with TextFile(filename, encoding) as f:
+                buf = make_buffer(read_lines_from(f), self.engine)
+        st = f.stat
+        self._log("O", self.current, filename, mapped, encoding, st.st_size, st.st_mtime_ns)
+        self._load(buf, filename)
+        mark_loaded(buf, filename, f.encoding, st, f.newline)  # 会话文件可以只保存对它的引用
+        return buf
+
+    def replace_all(self, operation, matcher, replacement):
+        """替换当前缓冲区中所有匹配并整体记一条历史，返回替换次数
+
+        历史里连续被替换的行合成一段；套用时每个块只改一次。替换串无效时抛出 re.error，此时缓冲区不变。
+        """
+        buf = self.buffer
+        changes = []
+        splices = []  # 每块一次：(起始行, 结束行, 新的行)
+        count = 0
+        idx = 0
+        for chunk in buf.iter_chunks():
+            if type(chunk) is not list:
+                chunk = list(chunk)
+            new_chunk = None
+            for i, line in matcher.grep((chunk,), idx):
+                new_line, n = matcher.subn(replacement, line)
+                if not n:
+                    continue
+                count += n
+                if new_chunk is None:
+                    new_chunk = chunk[:]
+                    first = i - idx
+                last = i - idx
+                new_chunk[last] = new_line
+                if changes and changes[-1][0] + len(changes[-1][1]) == i:
+                    changes[-1][1].append(line)
+                    changes[-1][2].append(new_line)
+                else:
+                    changes.append((i, [line], [new_line]))
+            if new_chunk is not None:
+                splices.append((idx + first, idx + last + 1, new_chunk[first:last + 1]))
+            idx += len(chunk)
+        if changes:
+            # 重放时从同样的内容出发再替换一遍，Journal 里只记替换的参数
+            self._log("C", self.current, operation, matcher.pattern, replacement, matcher.ignore_case, matcher.whole_word)
+            for start, stop, new_lines in splices:
+                buf.replace(start, stop, new_lines)
+            self.record(operation, changes)
+        return count
+
+    def _mapping(self, filename):
+        target = os.path.realpath(filename)
+        return [buf for buf in self.buffers
+                if isinstance(buf, MappedBuffer) and not buf.source._file.closed
+                and os.path.realpath(buf.source.filename) == target]
+
+    def is_mapped(self, filename):
+        """是否有缓冲区正映射着该文件（原地重写会破坏映射）"""
+        return bool(self._mapping(filename))
+
+    def _release_mapping(self, filename):
+        """覆盖文件前，在 Windows 上把映射了该文件的缓冲区读入内存并关闭映射
+
+        POSIX 上改名覆盖后旧文件仍然活着，映射不受影响；Windows 不允许替换被打开、映射着的文件。
+        """
+        if os.name == "nt":
+            for buf in self._mapping(filename):
+                buf.materialize()
+
+    def save(self, operation, filename, incremental=True, **kwargs):
+        """保存当前缓冲区到 filename，返回 save_buffer 的结果；真正写入时记一条历史
+
+        在当前线程直接写，不拍快照；要放到后台线程写时用 start_save/finish_save。
+        """
+        self._release_mapping(filename)
+        result = save_buffer(self.buffer, filename,
+                             incremental=incremental and not self.is_mapped(filename), **kwargs)
+        if result != "skipped":
+            self._after_save(self.current, operation, filename)
+        return result
+
+    def start_save(self, operation, filename, incremental=True, **kwargs):
+        """给当前缓冲区拍快照，返回 SaveJob；job.run() 可以在后台线程执行"""
+        self._release_mapping(filename)  # 快照还引用着映射的块，要在拍快照之前读入
+        return SaveJob(self.buffer, filename, operation,
+                       incremental=incremental and not self.is_mapped(filename), **kwargs)
+
+    def finish_save(self, job):
+        """在前台线程收尾：写入失败时重新抛出异常，成功时更新保存状态和文件名并记一条历史
+
+        返回被保存的缓冲区编号；保存期间该缓冲区已被删除或替换时返回 None。
+        """
+        buf = job.buf
+        if job.error is not None:
+            dirty = [d for d in (buf.dirty_from, job.snapshot.dirty_from) if d is not None]
+            buf.dirty_from = min(dirty) if dirty else None
+            raise job.error
+        # 快照写盘期间的修改已经记在 buf.dirty_from 里，相对的正是刚写下的内容
+        buf.saved = job.snapshot.saved
+        idx = next((i for i, b in enumerate(self.buffers) if b is buf), None)
+        if idx is not None and job.result != "skipped":
+            self._after_save(idx, job.operation, job.filename)
+        return idx
+
+    def _after_save(self, idx, operation, filename):
+        buf = self.buffers[idx]
+        self._log("W", idx, operation, filename, buf.saved, buf.dirty_from)
+        self._saved_as(idx, operation, filename)
+        if self.journal is not None:
+            # 之前打开的文件可能刚被覆盖，重放时再读就对不上了
+            self.journal.saved(self, filename)
+
+    def _saved_as(self, idx, operation, filename):
+        file_before = self.buffer_files[idx]
+        self.buffer_files[idx] = filename
+        self.record(operation, file_before=file_before, buf_idx=idx)
+
+    def new_buffer(self):
+        """新建一个空缓冲区并切换过去，返回它的编号"""
+        self._log("N")
+        self.buffers.append(make_buffer(engine=self.engine))
+        self.buffer_files.append("")
+        self.current = len(self.buffers) - 1
+        return self.current
+
+    def switch(self, n):
+        """切换到缓冲区 n，不存在时补齐空缓冲区"""
+        self._log("S", n)
+        while n >= len(self.buffers):
+            self.buffers.append(make_buffer(engine=self.engine))
+        while n >= len(self.buffer_files):
+            self.buffer_files.append("")
+        self.current = n
+
+    def remove(self, n):
+        """删除缓冲区 n；删掉的正是当前缓冲区时切换到 0 并返回 True"""
+        self._log("X", n)
+        self.buffers.pop(n)
+        self.buffer_files.pop(n)
+        self.history.drop_buffer(n)
+        if self.current == n:
+            self.current = 0
+            return True
+        if self.current > n:
+            self.current -= 1
+        return False
+
+    def undo(self):
+        """撤销最近一次操作并切换到对应缓冲区，返回 Delta；没有历史时返回 None"""
+        self._log("U")
+        delta = self.history.undo(self.buffers, self.buffer_files)
+        if delta is not None:
+            self.current = delta.buf_idx
+            self.last_edit = (delta.buf_idx, delta.undo_changes())
+        return delta
+
+    def redo(self):
+        self._log("Y")
+        delta = self.history.redo(self.buffers, self.buffer_files)
+        if delta is not None:
+            self.current = delta.buf_idx
+            self.last_edit = (delta.buf_idx, delta.changes)
+        return delta
+
+
+# 会话文件：魔数之后是一串帧，帧头为 4 字节类型和 8 字节长度，内容的第一个字节是标志位
+SESSION_MAGIC = b"NNSESS\x00\x01"
+_FRAME_HEADER = struct.Struct("<4sQ")
+_FRAME_ZLIB = 1  # 标志位：其余内容经过 zlib 压缩
+SESSION_ZLIB_LEVEL = 1  # 会话文件在退出时写，压缩取快不取小
+_JSON_LENGTH = struct.Struct("<I")
+_LINE_COUNT = struct.Struct("<Q")
+
+
+def _write_frame(f, tag, payload, compress):
+    flags = 0
+    if compress:
+        payload = zlib.compress(payload, SESSION_ZLIB_LEVEL)
+        flags = _FRAME_ZLIB
+    f.write(_FRAME_HEADER.pack(tag, len(payload) + 1))
+    f.write(bytes([flags]))
+    f.write(payload)
+
+
+def _read_frames(f):
+    while True:
+        header = f.read(_FRAME_HEADER.size)
+        if not header:
+            return
+        if len(header) != _FRAME_HEADER.size:
+            raise ValueError("truncated session file")
+        tag, length = _FRAME_HEADER.unpack(header)
+        data = f.read(length)
+        if len(data) != length or not length:
+            raise ValueError("truncated session file")
+        payload = memoryview(data)[1:]
+        yield tag, zlib.decompress(payload) if data[0] & _FRAME_ZLIB else payload
+
+
+def _dump_json(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8", "surrogatepass")
+
+
+def _load_json(data):
+    return json.loads(bytes(data).decode("utf-8", "surrogatepass"))
+
+
+def _reference_of(source, errors):
+    header = {
+        "path": os.path.realpath(source.filename),
+        "size": source.size,
+        "mtime_ns": source._identity[3],
+        "content_bytes": source.content_bytes,
+        "content_chars": source.content_chars,
+        "typecode": source.offsets.typecode,
+        "encoding": source.encoding,
+        "newline": source.newline,
+        "errors": errors,
+    }
+    return header, source.offsets
+
+
+def _file_reference(buf, inline=()):
+    """缓冲区与磁盘上的文件内容一致、且能按行映射时返回 (引用头部, 行偏移数组)，否则返回 None
+
+    inline 中的文件（realpath）一律不引用。
+    """
+    if buf.dirty_from is not None:
+        return None
+    if isinstance(buf, MappedBuffer) and buf.saved is None:
+        # 保存过的映射缓冲区与新写下的文件一致，不再与映射的源文件一致
+        if (buf.source._file.closed or os.path.realpath(buf.source.filename) in inline
+                or not buf.source.unchanged_on_disk()):
+            return None
+        return _reference_of(buf.source, buf.source.errors)
+    record = buf.saved or buf.origin
+    if record is None or record.path is None or record.path in inline:
+        return None
+    try:
+        st = os.stat(record.path)
+    except OSError:
+        return None
+    key = (record.path, record.size, record.mtime_ns)
+    if (st.st_size, st.st_mtime_ns) != key[1:]:
+        return None
+    if buf.file_index is not None and buf.file_index[0] == key:
+        return buf.file_index[1]
+    try:
+        # 扫描一遍建立行索引，恢复时就不必再扫；UTF-16 等无法映射的编码抛出 ValueError
+        source = MappedFile(record.path, record.encoding)
+    except (OSError, ValueError):
+        return None
+    try:
+        if ((source.size, source._identity[3]) != key[1:] or len(source) != len(buf)
+                or source.newline != record.newline):
+            return None
+        # 读入和保存时坏字节都按 surrogateescape 处理，恢复时也要还原回去
+        reference = _reference_of(source, "surrogateescape")
+    finally:
+        source.close()
+    buf.file_index = (key, reference)
+    return reference
+
+
+def _buffer_frame(buf, inline=()):
+    """返回 (帧类型, 内容, 引用的文件路径)；保存全文时路径为 None"""
+    reference = _file_reference(buf, inline)
+    if reference is None:
+        text = "\n".join(["\n".join(chunk) for chunk in buf.iter_chunks() if len(chunk)])
+        return b"TEXT", _LINE_COUNT.pack(len(buf)) + text.encode("utf-8", "surrogatepass"), None
+    header, offsets = reference
+    data = _dump_json(header)
+    return b"FILE", _JSON_LENGTH.pack(len(data)) + data + offsets.tobytes(), header["path"]
+
+
+def _restore_buffer(tag, payload, engine):
+    """返回恢复出的缓冲区；引用的文件已改变时返回 None"""
+    if tag == b"TEXT":
+        (count,) = _LINE_COUNT.unpack_from(payload)
+        text = bytes(payload[_LINE_COUNT.size:]).decode("utf-8", "surrogatepass")
+        return make_buffer(text.split("\n") if count else [], engine)
+    (length,) = _JSON_LENGTH.unpack_from(payload)
+    header = _load_json(payload[_JSON_LENGTH.size:_JSON_LENGTH.size + length])
+    offsets = array(header["typecode"])
+    offsets.frombytes(payload[_JSON_LENGTH.size + length:])
+    try:
+        source = MappedFile(header["path"], header.get("encoding", "utf-8"), header["errors"],
+                            index=(offsets, header["content_bytes"], header["content_chars"]))
+    except (OSError, ValueError):
+        return None
+    if (source.size, source._identity[3]) != (header["size"], header["mtime_ns"]):
+        source.close()
+        return None
+    buf = MappedBuffer(source)
+    buf.origin = SavedFile(header["path"], header["size"], header["mtime_ns"], len(buf),
+                           source.encoding, source.newline)
+    return buf
+
+
+def save_session(session, filename, compress=True, inline=()):
+    """把会话的缓冲区、文件名、历史和操作记录写入 filename（临时文件 + 改名）
+
+    与磁盘文件内容一致的缓冲区只保存路径、大小、修改时间和行索引，返回这些文件的路径列表；
+    其余缓冲区和 inline 中的文件（realpath）保存全文，compress 为真时逐个用 zlib 压缩。
+    """
+    references = []
+    path = os.path.realpath(filename)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix="." + os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(SESSION_MAGIC)
+            meta = {
+                "current": session.current,
+                "buffer_files": session.buffer_files,
+                "operation_history": session.operation_history,
+                # 每个缓冲区原来的 (编码, 换行符)，保存全文的缓冲区恢复后靠它按原格式写回
+                "formats": [text_format(buf) for buf in session.buffers],
+            }
+            _write_frame(f, b"META", _dump_json(meta), False)
+            for buf in session.buffers:
+                tag, payload, reference = _buffer_frame(buf, inline)
+                if reference is not None:
+                    references.append(reference)
+                _write_frame(f, tag, payload, compress)
+            history = {
+                name: [[d.buf_idx, d.operation, d.changes, d.file_before, d.file_after] for d in stack]
+                for name, stack in (("undo", session.history.undo_stack), ("redo", session.history.redo_stack))
+            }
+            _write_frame(f, b"HIST", _dump_json(history), compress)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    return references
+
+
+def restore_session(session, filename):
+    """用 save_session 写的文件替换 session 的全部内容，返回磁盘上已改变、无法恢复的文件列表
+
+    这些文件对应的缓冲区恢复为空，它们的历史一并丢弃。文件格式不对时抛出 ValueError。
+    """
+    with open(filename, "rb") as f:
+        if f.read(len(SESSION_MAGIC)) != SESSION_MAGIC:
+            raise ValueError(f"{filename} is not a NightNote session file")
+        meta = None
+        buffers = []
+        stale = []
+        history = {"undo": [], "redo": []}
+        for tag, payload in _read_frames(f):
+            if tag == b"META":
+                meta = _load_json(payload)
+            elif tag in (b"TEXT", b"FILE"):
+                buf = _restore_buffer(tag, payload, session.engine)
+                if buf is None:
+                    stale.append(len(buffers))
+                    buf = make_buffer(engine=session.engine)
+                buffers.append(buf)
+            elif tag == b"HIST":
+                history = _load_json(payload)
+    if meta is None or len(meta["buffer_files"]) != len(buffers) or not buffers:
+        raise ValueError(f"{filename} is incomplete")
+    for buf, (encoding, newline) in zip(buffers, meta.get("formats", ())):
+        if buf.origin is None and encoding is not None:
+            # 只记格式、不对应磁盘内容的记录；缓冲区算作已修改，不会被当成文件引用
+            buf.origin = SavedFile(None, None, None, len(buf), encoding, newline)
+            buf.dirty_from = 0
+    session.buffers[:] = buffers
+    session.buffer_files[:] = meta["buffer_files"]
+    session.current = meta["current"]
+    session.operation_history[:] = [tuple(entry) for entry in meta["operation_history"]]
+    session.last_edit = None
+    journal = session.history
+    journal.used = 0
+    for name, stack in (("undo", journal.undo_stack), ("redo", journal.redo_stack)):
+        stack[:] = [Delta(idx, operation, [tuple(change) for change in changes], before, after)
+                    for idx, operation, changes, before, after in history[name]]
+        journal.used += sum(delta.size for delta in stack)
+    for idx in stale:
+        journal.drop_buffer(idx, renumber=False)
+    return [session.buffer_files[idx] for idx in stale]
+
+
+# 预写日志：魔数和基准会话文件的 (大小, 修改时间) 之后是一串记录，
+# 记录头为 1 字节类型、4 字节长度和内容的 CRC32，内容是 JSON 数组
+JOURNAL_MAGIC = b"NNJRNL\x00\x01"
+_JOURNAL_BASE = struct.Struct("<QQ")
+_RECORD_HEADER = struct.Struct("<cII")
+JOURNAL_FSYNC_MS = 1000  # 默认至多每隔这么久落盘一次
+JOURNAL_BUFFER_BYTES = 64 * 1024  # 攒够这么多字节的记录就先写一次
+# 只记文件名的记录里文件名所在的位置，重放时要读这些文件当前的内容
+_SOURCE_FIELD = {"O": 1, "R": 3}
+
+
+class Journal:
+    """崩溃恢复用的预写日志，由 Session 在每个修改套用之前追加记录
+
+    path + ".base" 是最近一次检查点时的会话文件，path 记录之后的修改。记录先攒在内存里，
+    攒够 JOURNAL_BUFFER_BYTES、调用 flush()（命令行版在等待输入前调用）或按 fsync 策略
+    落盘时才一次写出："always" 每条记录都立即写出并落盘，"never" 只写出不落盘，
+    数字表示第一条未落盘的记录之后至多这么多毫秒在后台线程一起写出并落盘。
+    """
+
+    def __init__(self, path, fsync=JOURNAL_FSYNC_MS):
+        self.path = path
+        self.base = path + ".base"
+        self.fsync = fsync
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND | getattr(os, "O_BINARY", 0), 0o666)
+        self.records = 0  # 检查点之后的记录数
+        self.sources = set()  # 基准或记录依赖其当前内容的文件（realpath）
+        self.inline = set()  # 被保存覆盖过的文件，检查点里改存全文，免得下次覆盖时又要检查点
+        self._pending = []
+        self._pending_bytes = 0
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def append(self, kind, payload):
+        data = _dump_json(payload)
+        record = _RECORD_HEADER.pack(kind.encode("ascii"), len(data), zlib.crc32(data)) + data
+        if kind in _SOURCE_FIELD:
+            self.sources.add(os.path.realpath(payload[_SOURCE_FIELD[kind]]))
+        with self._lock:
+            self._pending.append(record)
+            self._pending_bytes += len(record)
+            self.records += 1
+            if self.fsync == "always":
+                self._write(True)
+                return
+            if self._pending_bytes >= JOURNAL_BUFFER_BYTES:
+                self._write(False)
+            if self.fsync != "never" and self._timer is None:
+                self._timer = threading.Timer(self.fsync / 1000, self.sync)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _write(self, sync):
+        if self._pending:
+            os.write(self.fd, b"".join(self._pending))
+            self._pending = []
+            self._pending_bytes = 0
+        if sync:
+            os.fsync(self.fd)
+
+    def flush(self):
+        """把攒着的记录写给操作系统（进程崩溃不会丢，掉电可能丢）"""
+        with self._lock:
+            if self.fd is not None:
+                self._write(False)
+
+    def sync(self):
+        with self._lock:
+            self._timer = None
+            if self.fd is not None:
+                self._write(True)
+
+    def saved(self, session, filename):
+        """filename 刚被保存覆盖；基准或记录还依赖它原来的内容时做一次检查点"""
+        path = os.path.realpath(filename)
+        if path in self.sources:
+            self.inline.add(path)
+            self.checkpoint(session)
+
+    def checkpoint(self, session):
+        """把会话整个存为基准文件，清空记录；基准文件换掉之后旧的记录即作废"""
+        self.sources = set(save_session(session, self.base, inline=self.inline))
+        fd = os.open(self.base, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        try:
+            os.fsync(fd)
+            st = os.fstat(fd)
+        finally:
+            os.close(fd)
+        _fsync_dir(os.path.dirname(os.path.realpath(self.base)))
+        with self._lock:
+            # 还没写出的记录已经包含在新的基准里
+            self._pending = []
+            self._pending_bytes = 0
+            os.ftruncate(self.fd, 0)
+            os.write(self.fd, JOURNAL_MAGIC + _JOURNAL_BASE.pack(st.st_size, st.st_mtime_ns))
+            os.fsync(self.fd)
+        self.records = 0
+
+    def close(self, remove=False):
+        """写出剩下的记录并关闭；remove 为真时删除日志和基准文件（正常退出时已无需恢复）"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self.fd is None:
+                return
+            if not remove:
+                self._write(self.fsync != "never")
+            os.close(self.fd)
+            self.fd = None
+        if remove:
+            for name in (self.path, self.base):
+                try:
+                    os.unlink(name)
+                except FileNotFoundError:
+                    pass
+
+
+def _read_records(f):
+    """依次产出 (类型, 内容)；末尾写了一半的记录（崩溃时常见）直接忽略"""
+    while True:
+        header = f.read(_RECORD_HEADER.size)
+        if len(header) != _RECORD_HEADER.size:
+            return
+        kind, length, crc = _RECORD_HEADER.unpack(header)
+        data = f.read(length)
+        if len(data) != length or zlib.crc32(data) != crc:
+            return
+        yield kind.decode("ascii"), _load_json(data)
+
+
+def _check_unchanged(filename, size, mtime_ns):
+    st = os.stat(filename)
+    if (st.st_size, st.st_mtime_ns) != (size, mtime_ns):
+        raise ValueError(f"'{filename}' changed on disk")
+
+
+def _replay_record(session, kind, payload):
+    if kind in "ECLOR":
+        session.current = payload[0]
+    if kind == "E":
+        session.edit(*payload[1:])
+    elif kind == "C":
+        operation, pattern, replacement, ignore_case, whole_word = payload[1:]
+        session.replace_all(operation, get_matcher(pattern, ignore_case, whole_word), replacement)
+    elif kind == "L":
+        session.load(*payload[1:])
+    elif kind == "O":
+        filename, mapped, encoding, size, mtime_ns = payload[1:]
+        _check_unchanged(filename, size, mtime_ns)
+        session.open(filename, encoding, mapped)
+    elif kind == "R":
+        operation, n, filename, encoding, size, mtime_ns = payload[1:]
+        _check_unchanged(filename, size, mtime_ns)
+        session.read_file(operation, n, filename, encoding)
+    elif kind == "W":
+        idx, operation, filename, saved, dirty_from = payload
+        session._saved_as(idx, operation, filename)
+        # 写下的文件之后没再变过，才能恢复保存状态，之后的保存仍可跳过或只重写尾部
+        if saved is not None:
+            saved = SavedFile(*saved)
+            try:
+                st = os.stat(saved.path)
+            except OSError:
+                st = None
+            if st is not None and (st.st_size, st.st_mtime_ns) == (saved.size, saved.mtime_ns):
+                buf = session.buffers[idx]
+                buf.saved, buf.dirty_from = saved, dirty_from
+    elif kind == "U":
+        session.undo()
+    elif kind == "Y":
+        session.redo()
+    elif kind == "N":
+        session.new_buffer()
+    elif kind == "S":
+        session.switch(*payload)
+    elif kind == "X":
+        session.remove(*payload)
+    else:
+        raise ValueError(f"unknown record type {kind!r}")
+
+
+def replay_journal(session, path):
+    """把上次没有正常退出时留下的日志恢复进 session
+
+    返回 (重放的记录数, 基准里磁盘上已改变的文件列表, 出错原因)；没有日志时返回 (0, [], None)。
+    某条记录无法重放（例如它打开的文件已被改动）时停在那里，出错原因为说明文字，否则为 None。
+    基准文件格式不对时抛出 ValueError。
+    """
+    base = path + ".base"
+    if not os.path.exists(base):
+        return 0, [], None
+    stale = restore_session(session, base)
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return 0, stale, None
+    count = 0
+    journal, session.journal = session.journal, None
+    try:
+        with f:
+            header = f.read(len(JOURNAL_MAGIC) + _JOURNAL_BASE.size)
+            st = os.stat(base)
+            # 检查点先换基准文件再清空记录，两者对不上说明记录已经包含在基准里
+            if header != JOURNAL_MAGIC + _JOURNAL_BASE.pack(st.st_size, st.st_mtime_ns):
+                return 0, stale, None
+            for kind, payload in _read_records(f):
+                try:
+                    _replay_record(session, kind, payload)
+                except (LookupError, TypeError, ValueError, OSError) as e:
+                    return count, stale, f"record {count + 1} ({kind}): {e}"
+                count += 1
+    finally:
+        session.journal = journal
+    return count, stale, None